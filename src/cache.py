@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+from common import Common
+from transfer import Transfer
+
+global step_cache
+step_cache = None
+step_cache_lock = threading.Lock()
+
+class StepCache:
+
+    # Results of image steps, stored on disk as <path>/<key>/output and <path>/<key>/status.
+    # The key is computed from the image ID, the command and the contents of all read-only volumes.
+    # The index (with the size and the time each entry was last used) is saved when entries are
+    # added or evicted, and by save() at the end of a run, not on every cache hit.
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.restoring = {}  # key => number of restores in progress, which must not be evicted
+        self.changed = False  # whether the index has changed since it was saved
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self.index = Common.load_json(os.path.join(self.path, 'index.json'), {})
+        for key in list(self.index.keys()):
+            if not os.path.isdir(os.path.join(self.path, key)):
+                del self.index[key]
+        for item in os.listdir(self.path):
+            if os.path.isdir(os.path.join(self.path, item)) and not item in self.index:
+                shutil.rmtree(os.path.join(self.path, item), ignore_errors=True)
+
+    @staticmethod
+    def get():
+        global step_cache
+        with step_cache_lock:
+            if step_cache is None and Common.get_config("cache-path", None):
+                step_cache = StepCache(Common.get_config("cache-path", None), Common.parse_size(Common.get_config("cache-max-size", "10G")))
+        return step_cache
+
+    def key(self, image_id, volumes, command=None):
+        hasher = hashlib.sha256()
+        hasher.update(image_id.encode('utf-8') + b'\0')
+        hasher.update(json.dumps(command).encode('utf-8') + b'\0')
+        start_time = time.time()
+        for volume in sorted(volumes, key=lambda volume: volumes[volume]['bind']):
+            if volumes[volume]['mode'] != 'ro':
+                continue
+            hasher.update(volumes[volume]['bind'].encode('utf-8') + b'\0' + Common.hashtree(volume))
+        Common.add_timing('hash', time.time() - start_time)
+        return hasher.hexdigest()
+
+    def restore(self, key, output_path, status_path):
+        with self.lock:
+            if not key in self.index:
+                self.misses += 1
+                return False
+            self.hits += 1
+            self.index[key]['used'] = time.time()
+            self.changed = True
+            self.restoring[key] = self.restoring.get(key, 0) + 1
+        try:
+            # the entries are not hardlinked, as the restored files may end up in the output
+            entry_path = os.path.join(self.path, key)
+            Transfer.copy_contents(os.path.join(entry_path, 'output'), output_path, link=False)
+            Transfer.copy_contents(os.path.join(entry_path, 'status'), status_path, link=False)
+        finally:
+            with self.lock:
+                self.restoring[key] -= 1
+                if not self.restoring[key]:
+                    del self.restoring[key]
+        return True
+
+    def store(self, key, output_path, status_path):
+        entry_temp_path = tempfile.mkdtemp(prefix=key+'-', dir=self.path)
+        Transfer.copy_contents(output_path, os.path.join(entry_temp_path, 'output'), link=False)
+        Transfer.copy_contents(status_path, os.path.join(entry_temp_path, 'status'), link=False)
+        size = Common.tree_size(entry_temp_path)
+        with self.lock:
+            if key in self.index or size > self.max_size:
+                shutil.rmtree(entry_temp_path)
+                return
+            os.rename(entry_temp_path, os.path.join(self.path, key))
+            self.index[key] = { 'size': size, 'used': time.time() }
+            self.evict()
+            self.save_index()
+
+    def evict(self):
+        # remove least recently used entries until the cache fits within max_size
+        total_size = sum([self.index[key]['size'] for key in self.index])
+        for key in sorted(self.index, key=lambda key: self.index[key]['used']):
+            if total_size <= self.max_size:
+                break
+            if key in self.restoring:
+                continue
+            shutil.rmtree(os.path.join(self.path, key), ignore_errors=True)
+            total_size -= self.index[key]['size']
+            del self.index[key]
+
+    def save(self):
+        # saves the times the entries were last used, if they have been used since the index was saved
+        with self.lock:
+            if self.changed:
+                self.save_index()
+
+    def save_index(self):
+        Common.save_json(os.path.join(self.path, 'index.json'), self.index)
+        self.changed = False
@@ -4,26 +4,62 @@ import os
 import sys
 import re
 from pprint import pprint
-from slacker import Slacker
 import yaml
-from yaml.composer import Composer
 from yaml.constructor import Constructor
+import pickle
 import gettext
+import atexit
 import docker
 import hashlib
+from messages import Messages, StdoutSink, SlackSink, JsonLinesSink
+import json
+import threading
+import time
+import itertools
+import tarfile
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 
 global config
 global translation
 global _
-global slack
+global messages
 global docker_client
 global docker_container_id
 
+messages = None
+message_buffer = threading.local()
+docker_builds = {}
+docker_builds_lock = threading.Lock()
+build_executor = None
+docker_stats = {}
+docker_stats_lock = threading.Lock()
+timings = {}
+timings_lock = threading.Lock()
+mounts = None
+mounts_lock = threading.Lock()
+
+class LocationLoader(yaml.CLoader if hasattr(yaml, 'CLoader') else yaml.Loader):
+    
+    # Adds the location in the YAML file to every mapping. Uses libyaml when it is available;
+    # both loaders record the start of each node, which is where the mapping begins.
+    
+    basename = None
+    
+    def construct_mapping(self, node, deep=False):
+        mapping = Constructor.construct_mapping(self, node, deep=deep)
+        mapping['__line__'] = node.start_mark.line + 1
+        mapping['__column__'] = node.start_mark.column + 1
+        mapping['__basename__'] = self.basename
+        mapping['__location__'] = self.basename+":"+str(node.start_mark.line + 1)
+        return mapping
+
 class Common:
 
     @staticmethod
     def init(path, docker_container):
-        global config, translation, _, slack, docker_client, docker_container_id
+        global config, translation, _, messages, docker_client, docker_container_id, build_executor
         
         config = Common.load_yaml(path)
         
@@ -32,16 +68,25 @@ class Common:
         
         docker_container_id = docker_container
         docker_client = docker.Client(base_url='unix://var/run/docker.sock')
+        Common.invalidate_mounts()
+        build_executor = ThreadPoolExecutor(max_workers=int(Common.get_config("build-workers", 4)))
         
-        slack = {"slack": None, "channel": None, "botname": None}
+        queue_size = int(Common.get_config("message-queue-size", 10000))
+        sinks = []
         if os.path.exists("/mnt/config/slack.token"):
             with open("/mnt/config/slack.token", 'r') as f:
                 slack_token = f.readline().rstrip()
-            slack["slack"] = Slacker(slack_token)
-            slack["botname"] = config.get("slack-botname", "docker-pipeline")
-            slack["channel"] = config.get("slack-channel", "#test")
+            sinks.append(SlackSink(slack_token,
+                                   Common.get_config("slack-channel", "#test"),
+                                   Common.get_config("slack-botname", "docker-pipeline"),
+                                   interval=float(Common.get_config("slack-interval", 1.0)),
+                                   queue_size=queue_size))
         else:
-            pass # print(_("No slack token available, won't post to Slack"+": /mnt/config/slack.token"))
+            sinks.append(StdoutSink(queue_size=queue_size))
+        if Common.get_config("message-log", None):
+            sinks.append(JsonLinesSink(Common.get_config("message-log", None), queue_size=queue_size))
+        messages = Messages(sinks)
+        atexit.register(Common.close_messages)
 
     @staticmethod
     def get_config(key, default):
@@ -52,13 +97,56 @@ class Common:
 
     @staticmethod
     def message(msg):
-        global slack
-        if slack["slack"]:
-            slack.chat.post_message(slack["channel"], msg, slack["botname"])
+        buffer = getattr(message_buffer, 'lines', None)
+        if buffer is not None:
+            buffer.append(msg)
+            return
+        if messages:
+            messages.put(msg)
         else:
             print(msg)
             sys.stdout.flush()
 
+    @staticmethod
+    def close_messages():
+        # waits until all messages have been written
+        if messages:
+            messages.close()
+
+    @staticmethod
+    def run_parallel(function, items, workers):
+        # results are yielded in the same order as items; when running concurrently, the messages
+        # from each item are buffered and emitted together once that item is done. At most
+        # workers*2 items are started ahead of the first unfinished one, so that a slow item
+        # doesn't make the buffered results of all the others pile up.
+        items = list(items)
+        if workers <= 1 or len(items) <= 1:
+            for item in items:
+                yield function(item)
+            return
+        
+        def run_buffered(item):
+            message_buffer.lines = []
+            try:
+                return function(item), message_buffer.lines, None
+            except Exception as e:
+                return None, message_buffer.lines, e
+            finally:
+                message_buffer.lines = None
+        
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            remaining = iter(items)
+            futures = deque([ executor.submit(run_buffered, item) for item in itertools.islice(remaining, workers * 2) ])
+            while futures:
+                result, lines, error = futures.popleft().result()
+                for item in itertools.islice(remaining, 1):
+                    futures.append(executor.submit(run_buffered, item))
+                for line in lines:
+                    Common.message(line)
+                if error:
+                    raise error
+                yield result
+
     @staticmethod
     def list_files(directory, shallow=False):
         files = []
@@ -75,33 +163,38 @@ class Common:
         return files
 
     @staticmethod
-    def load_yaml(path):
+    def load_yaml(path, cache_path=None):
         config = None
         if os.path.exists(path):
             try:
-                with open(path, 'r') as file:
-                    basename = os.path.basename(path)
-                    loader = yaml.Loader(file.read())
-                    def compose_node(parent, index):
-                        # the line number where the previous token has ended (plus empty lines)
-                        line = loader.line
-                        column = loader.column
-                        node = Composer.compose_node(loader, parent, index)
-                        node.__line__ = line + 1
-                        node.__column__ = column + 1
-                        node.__basename__ = basename
-                        node.__location__ = basename+":"+str(line + 1)
-                        return node
-                    def construct_mapping(node, deep=False):
-                        mapping = Constructor.construct_mapping(loader, node, deep=deep)
-                        mapping['__line__'] = node.__line__
-                        mapping['__column__'] = node.__column__
-                        mapping['__basename__'] = node.__basename__
-                        mapping['__location__'] = node.__location__
-                        return mapping
-                    loader.compose_node = compose_node
-                    loader.construct_mapping = construct_mapping
+                with open(path, 'rb') as file:
+                    content = file.read()
+                basename = os.path.basename(path)
+                
+                cache_file = None
+                if cache_path:
+                    # the locations include the basename, so it is part of the key
+                    cache_file = cache_path+"/"+hashlib.sha256(basename.encode('utf-8')+b'\0'+content).hexdigest()+".pickle"
+                    if os.path.exists(cache_file):
+                        try:
+                            with open(cache_file, 'rb') as f:
+                                return pickle.load(f)
+                        except (pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+                            Common.message("WARNING: unable to read cached YAML file: "+cache_file)
+                
+                loader = LocationLoader(content)
+                loader.basename = basename
+                try:
                     config = loader.get_single_data()
+                finally:
+                    loader.dispose()
+                
+                if cache_file:
+                    if not os.path.isdir(cache_path):
+                        os.makedirs(cache_path)
+                    with open(cache_file+'.tmp', 'wb') as f:
+                        pickle.dump(config, f, pickle.HIGHEST_PROTOCOL)
+                    os.rename(cache_file+'.tmp', cache_file)
                     
             except (yaml.error.YAMLError, yaml.reader.ReaderError, yaml.scanner.ScannerError) as e:
                 message(e)
@@ -112,9 +205,29 @@ class Common:
         return config
 
     @staticmethod
-    def docker_build(path):
+    def load_json(path, default):
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    return json.load(f)
+            except ValueError:
+                Common.message("WARNING: unable to parse JSON file: "+path)
+        return default
+
+    @staticmethod
+    def save_json(path, data):
+        if os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path+'.tmp', 'w') as f:
+            json.dump(data, f)
+        os.rename(path+'.tmp', path)
+
+    @staticmethod
+    def docker_build(path, client=None):
         Common.message("Building docker image: "+path)
-        response = [line for line in docker_client.build(path=path, rm=True, forcerm=True)]
+        start_time = time.time()
+        response = [line for line in Common.docker_call('build', path=path, rm=True, forcerm=True, client=client)]
+        Common.add_timing('build', time.time() - start_time)
         image_id = None
         for line in reversed(response):
             line_text = eval(line)['stream'].strip()
@@ -124,28 +237,230 @@ class Common:
         return image_id
 
     @staticmethod
-    def docker_run(image, volumes, command=None):
-        container_details = docker_client.inspect_container(docker_container_id)
+    def docker_build_async(path):
+        # returns a future for the image ID. Builds are shared between all steps using the same
+        # unchanged directory, and independent directories are built concurrently.
+        path = os.path.normpath(path)
+        fingerprint = Common.fingerprint(path)
+        with docker_builds_lock:
+            if not (path, fingerprint) in docker_builds:
+                docker_builds[(path, fingerprint)] = build_executor.submit(Common.docker_build_cached, path, fingerprint)
+            return docker_builds[(path, fingerprint)]
+
+    @staticmethod
+    def docker_build_cached(path, fingerprint):
+        build_cache_path = Common.get_config("build-cache", None)
+        if not build_cache_path:
+            return Common.docker_build(path)
+        
+        with docker_builds_lock:
+            build_cache = Common.load_json(build_cache_path, {})
+        if path in build_cache and build_cache[path]['fingerprint'] == fingerprint:
+            Common.message("Using previously built docker image: "+path)
+            return build_cache[path]['id']
+        
+        image_id = Common.docker_build(path)
+        if image_id:
+            with docker_builds_lock:
+                build_cache = Common.load_json(build_cache_path, {})
+                build_cache[path] = { 'fingerprint': fingerprint, 'id': image_id }
+                Common.save_json(build_cache_path, build_cache)
+        return image_id
+
+    @staticmethod
+    def docker_image_id(image):
+        return Common.docker_call('inspect_image', image)['Id']
+
+    @staticmethod
+    def docker_run(image, volumes, command=None, stats=None, resources=False, client=None, staged=False, cpus=None, memory=None):
+        # if a stats dictionary is given, the time spent in each phase of the container's life
+        # is recorded in it, and with resources also the peak memory and CPU usage.
+        # With staged, the volumes are copied into and out of the container instead of being
+        # mounted, for docker hosts that don't share the file system with this container.
+        # cpus and memory (bytes) limit the resources available to the container.
+        client = client or docker_client
+        limits = {}
+        if cpus:
+            limits['cpu_period'] = 100000
+            limits['cpu_quota'] = int(cpus * 100000)
+        if memory:
+            limits['mem_limit'] = memory
         host_volumes = {}
-        for volume in volumes:
+        for volume in volumes if not staged else []:
             new_volume = Common.host_path(volume)
             if new_volume:
                 host_volumes[new_volume] = volumes[volume]
-        container = docker_client.create_container(image, host_config=docker_client.create_host_config(binds=host_volumes), command=command)
-        docker_client.start(container=container)
-        log_stream = docker_client.logs(container=container, stream=True)
-        for line in log_stream:
-            Common.message(line)
-        docker_client.wait(container=container)
-        docker_client.remove_container(container=container)
+        phase_start = time.time()
+        container = Common.docker_call('create_container', image, host_config=client.create_host_config(binds=host_volumes, **limits), command=command, client=client)
+        sampler = None
+        stopped = threading.Event()
+        # the sampler only replaces these values, so that they can be copied while it is running
+        samples = { 'peak_memory': 0, 'peak_cpu': 0.0 }
+        try:
+            if staged:
+                Common.docker_put_volumes(container, volumes, client)
+            if stats is not None:
+                stats['create'] = time.time() - phase_start
+                phase_start = time.time()
+            Common.docker_call('start', container=container, client=client)
+            if stats is not None:
+                stats['start'] = time.time() - phase_start
+                phase_start = time.time()
+                if resources:
+                    sampler = threading.Thread(target=Common.docker_sample_resources, args=(container, samples, stopped, client))
+                    sampler.daemon = True
+                    sampler.start()
+            log_stream = Common.docker_call('logs', container=container, stream=True, client=client)
+            for line in log_stream:
+                Common.message(line)
+            exit_code = Common.docker_call('wait', container=container, client=client)
+            if stats is not None:
+                stats['run'] = time.time() - phase_start
+                if sampler:
+                    # the sampler may be waiting for the next sample from the daemon
+                    stopped.set()
+                    sampler.join(2.0)
+                    stats.update(dict(samples))
+                phase_start = time.time()
+            if staged:
+                Common.docker_get_volumes(container, volumes, client)
+        except Exception:
+            stopped.set()
+            # the container could still be running (for instance if the connection to the daemon was lost),
+            # and must not keep writing to the volumes when the step is retried
+            try:
+                Common.docker_call('remove_container', container=container, force=True, client=client)
+            except Exception:
+                pass
+            raise
+        Common.docker_call('remove_container', container=container, client=client)
+        if stats is not None:
+            stats['remove'] = time.time() - phase_start
+        return exit_code
+
+    @staticmethod
+    def docker_put_volumes(container, volumes, client):
+        # copies the read-only volumes into /mnt in a created container, and creates empty directories for the others
+        with tempfile.TemporaryFile() as archive:
+            with tarfile.open(fileobj=archive, mode='w') as tar:
+                for volume in sorted(volumes, key=lambda volume: volumes[volume]['bind']):
+                    name = os.path.relpath(volumes[volume]['bind'], '/mnt')
+                    if '/' in name:
+                        Common.add_tar_directory(tar, os.path.dirname(name))
+                    if volumes[volume]['mode'] == 'ro':
+                        tar.add(volume, arcname=name)
+                    else:
+                        Common.add_tar_directory(tar, name)
+            archive.seek(0)
+            Common.docker_call('put_archive', container, '/mnt', archive, client=client)
+
+    @staticmethod
+    def add_tar_directory(tar, name):
+        info = tarfile.TarInfo(name)
+        info.type = tarfile.DIRTYPE
+        info.mode = 0o777
+        info.mtime = time.time()
+        tar.addfile(info)
+
+    @staticmethod
+    def docker_get_volumes(container, volumes, client):
+        # copies the contents of the writable volumes out of a stopped container
+        for volume in volumes:
+            if volumes[volume]['mode'] == 'ro':
+                continue
+            stream, stat = Common.docker_call('get_archive', container, volumes[volume]['bind'], client=client)
+            with tarfile.open(fileobj=stream, mode='r|') as tar:
+                for member in tar:
+                    # the archive contains the directory itself; only its contents are extracted.
+                    # Links are skipped, so that nothing can be written outside of the volume.
+                    parts = member.name.split('/')
+                    if len(parts) < 2 or member.name.startswith('/') or '..' in parts or member.issym() or member.islnk():
+                        continue
+                    member.name = '/'.join(parts[1:])
+                    tar.extract(member, volume)
+
+    @staticmethod
+    def docker_sample_resources(container, stats, stopped, client=None):
+        # records the peak memory usage (bytes) and CPU usage (percent of one CPU) of a running container
+        # in stats, until stopped is set
+        try:
+            for sample in Common.docker_call('stats', container, decode=True, stream=True, client=client):
+                if stopped.is_set():
+                    break
+                memory = sample.get('memory_stats', {}).get('usage', 0)
+                stats['peak_memory'] = max(stats.get('peak_memory', 0), memory)
+                cpu = sample.get('cpu_stats', {})
+                precpu = sample.get('precpu_stats', {})
+                cpu_delta = cpu.get('cpu_usage', {}).get('total_usage', 0) - precpu.get('cpu_usage', {}).get('total_usage', 0)
+                system_delta = cpu.get('system_cpu_usage', 0) - precpu.get('system_cpu_usage', 0)
+                if cpu_delta > 0 and system_delta > 0:
+                    cpus = len(cpu.get('cpu_usage', {}).get('percpu_usage', None) or [None])
+                    stats['peak_cpu'] = max(stats.get('peak_cpu', 0.0), 100.0 * cpu_delta / system_delta * cpus)
+        except Exception:
+            pass  # the container may be gone before the first sample
+
+    @staticmethod
+    def docker_call(method, *args, client=None, **kwargs):
+        # all requests to the docker daemons go through here, so that the number of requests
+        # and the time spent waiting for the daemons can be reported
+        start_time = time.time()
+        try:
+            return getattr(client or docker_client, method)(*args, **kwargs)
+        finally:
+            with docker_stats_lock:
+                if not method in docker_stats:
+                    docker_stats[method] = { 'calls': 0, 'seconds': 0.0 }
+                docker_stats[method]['calls'] += 1
+                docker_stats[method]['seconds'] += time.time() - start_time
+
+    @staticmethod
+    def docker_api_stats():
+        with docker_stats_lock:
+            return dict([(method, dict(docker_stats[method])) for method in docker_stats])
+
+    @staticmethod
+    def add_timing(activity, seconds):
+        # time spent on activities outside of the containers, like building images or hashing files
+        with timings_lock:
+            timings[activity] = timings.get(activity, 0.0) + seconds
+
+    @staticmethod
+    def timings():
+        with timings_lock:
+            return dict(timings)
+
+    @staticmethod
+    def container_mounts():
+        # maps the mount destinations in this container to their source paths on the host.
+        # Fetched from the daemon once and kept until invalidate_mounts is called.
+        global mounts
+        with mounts_lock:
+            if mounts is None:
+                container_details = Common.docker_call('inspect_container', docker_container_id)
+                mounts = {}
+                for mount in container_details['Mounts']:
+                    if 'Source' in mount and 'Destination' in mount:
+                        destination = mount['Destination'].rstrip('/') or '/'
+                        mounts[destination] = mount['Source'] if destination != '/' else mount['Source'].rstrip('/')
+            return mounts
+
+    @staticmethod
+    def invalidate_mounts():
+        global mounts
+        with mounts_lock:
+            mounts = None
 
     @staticmethod
     def host_path(path):
-        container_details = docker_client.inspect_container(docker_container_id)
-        for mount in container_details['Mounts']:
-            if 'Source' in mount and 'Destination' in mount and path.startswith(mount['Destination']):
-                return mount['Source']+path[len(mount['Destination']):]
-        return None
+        # longest matching mount destination, found by walking up the parent directories of path
+        container_mounts = Common.container_mounts()
+        prefix = path.rstrip('/') or '/'
+        while True:
+            if prefix in container_mounts:
+                return container_mounts[prefix]+path[len(prefix):] if prefix != '/' else container_mounts[prefix]+path
+            if prefix == '/' or not prefix:
+                return None
+            prefix = os.path.dirname(prefix)
 
     @staticmethod
     def hashfile(path):
@@ -159,6 +474,68 @@ class Common:
             return hasher.digest()
         return None
     
+    @staticmethod
+    def hashtree(path):
+        # Merkle-style hash: a directory hashes the names and hashes of its entries
+        hasher = hashlib.sha256()
+        if os.path.isdir(path):
+            hasher.update(b'dir\0')
+            for item in sorted(os.listdir(path)):
+                hasher.update(item.encode('utf-8') + b'\0' + Common.hashtree(os.path.join(path, item)))
+        else:
+            hasher.update(b'file\0' + Common.hashfile(path))
+        return hasher.digest()
+    
+    @staticmethod
+    def fingerprint(path):
+        # cheap alternative to hashtree, based only on file names, sizes and modification times
+        hasher = hashlib.sha256()
+        if os.path.isdir(path):
+            for root, subdirs, files in os.walk(path):
+                subdirs.sort()
+                for file in sorted(files):
+                    stat = os.stat(os.path.join(root, file))
+                    hasher.update((os.path.relpath(os.path.join(root, file), path)+'\0'+str(stat.st_size)+'\0'+str(stat.st_mtime_ns)+'\0').encode('utf-8'))
+        elif os.path.exists(path):
+            stat = os.stat(path)
+            hasher.update((str(stat.st_size)+'\0'+str(stat.st_mtime_ns)).encode('utf-8'))
+        return hasher.hexdigest()
+    
+    @staticmethod
+    def tree_size(path):
+        if not os.path.isdir(path):
+            return os.path.getsize(path)
+        size = 0
+        for root, subdirs, files in os.walk(path):
+            for file in files:
+                size += os.path.getsize(os.path.join(root, file))
+        return size
+    
+    @staticmethod
+    def tree_stats(path):
+        # the number of files and total size in bytes
+        if not os.path.exists(path):
+            return 0, 0
+        if not os.path.isdir(path):
+            return 1, os.path.getsize(path)
+        count = 0
+        size = 0
+        for root, subdirs, files in os.walk(path):
+            for file in files:
+                count += 1
+                size += os.path.getsize(os.path.join(root, file))
+        return count, size
+    
+    @staticmethod
+    def parse_size(size):
+        if isinstance(size, int):
+            return size
+        units = { 'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4 }
+        size = str(size).strip().upper().rstrip('B')
+        if size and size[-1] in units:
+            return int(float(size[:-1]) * units[size[-1]])
+        return int(size)
+    
     @staticmethod
     def first_line(path):
         for root, subdirs, files in os.walk(path):
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+import codecs
+import difflib
+import mimetypes
+from collections import deque
+
+class Diff:
+
+    # Diffs of files that may be too large to read into memory. The files are compared block by
+    # block to find the first difference, and only a window of lines starting a few lines before
+    # that is read and diffed.
+
+    @staticmethod
+    def is_text(path):
+        mime = mimetypes.guess_type(path)[0]
+        if mime:
+            return mime.startswith('text/') or mime.endswith('+xml') or mime in ['application/xml', 'application/json', 'application/javascript']
+        with open(path, 'rb') as f:
+            sample = f.read(8192)
+        if b'\0' in sample:
+            return False
+        try:
+            codecs.getincrementaldecoder('utf-8')().decode(sample, final=False)
+            return True
+        except UnicodeDecodeError:
+            return False
+
+    @staticmethod
+    def first_difference(expected_path, actual_path, context_lines=3, blocksize=65536):
+        # returns the offset and line number of the start of the line that is context_lines lines
+        # before the first difference, or None if the files are identical
+        offset = 0
+        line = 0
+        line_starts = deque([(0, 0)], maxlen=context_lines+1)
+        with open(expected_path, 'rb') as expected_file:
+            with open(actual_path, 'rb') as actual_file:
+                while True:
+                    expected_block = expected_file.read(blocksize)
+                    actual_block = actual_file.read(blocksize)
+                    if expected_block == actual_block and not expected_block:
+                        return None
+                    common_block = expected_block
+                    if expected_block != actual_block:
+                        common_length = 0
+                        max_length = min(len(expected_block), len(actual_block))
+                        while common_length < max_length and expected_block[common_length] == actual_block[common_length]:
+                            common_length += 1
+                        common_block = expected_block[:common_length]
+
+                    # only the last few line starts in each block can be needed
+                    block_line_starts = []
+                    position = len(common_block)
+                    while len(block_line_starts) < context_lines+1:
+                        position = common_block.rfind(b'\n', 0, position)
+                        if position < 0:
+                            break
+                        block_line_starts.insert(0, position)
+                    newlines = common_block.count(b'\n')
+                    for i, position in enumerate(block_line_starts):
+                        line_starts.append((offset+position+1, line+newlines-len(block_line_starts)+i+1))
+
+                    if expected_block != actual_block:
+                        return line_starts[0]
+                    offset += len(expected_block)
+                    line += newlines
+
+    @staticmethod
+    def read_lines(path, offset, max_lines, max_line_length=10000):
+        # returns the lines, and whether the end of the file was reached
+        lines = []
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            while len(lines) < max_lines:
+                line = f.readline(max_line_length)
+                if not line:
+                    return lines, True
+                lines.append(line.decode('utf-8', 'replace'))
+            return lines, not f.read(1)
+
+    @staticmethod
+    def unified_diff(expected_path, actual_path, fromfile, tofile, context_lines=3, window_lines=200):
+        # yields the lines of a unified diff for a window of lines around the first difference
+        start = Diff.first_difference(expected_path, actual_path, context_lines=context_lines)
+        if start is None:
+            return
+        offset, line = start
+        expected_lines, expected_eof = Diff.read_lines(expected_path, offset, window_lines)
+        actual_lines, actual_eof = Diff.read_lines(actual_path, offset, window_lines)
+        
+        yield '--- '+fromfile
+        yield '+++ '+tofile
+        matcher = difflib.SequenceMatcher(None, expected_lines, actual_lines, autojunk=False)
+        for group_number, group in enumerate(matcher.get_grouped_opcodes(context_lines)):
+            first, last = group[0], group[-1]
+            # differences at the end of a window that doesn't reach the end of the file
+            # may only be caused by the window being cut off
+            truncated = last[2] == len(expected_lines) and not expected_eof or last[4] == len(actual_lines) and not actual_eof
+            if truncated and group_number > 0:
+                break
+            yield '@@ -'+Diff.range(first[1], last[2], line)+' +'+Diff.range(first[3], last[4], line)+' @@'
+            for tag, i1, i2, j1, j2 in group:
+                if tag == 'equal':
+                    for diffline in expected_lines[i1:i2]:
+                        yield ' '+diffline.rstrip("\n")
+                    continue
+                for diffline in expected_lines[i1:i2]:
+                    yield '-'+diffline.rstrip("\n")
+                for diffline in actual_lines[j1:j2]:
+                    yield '+'+diffline.rstrip("\n")
+
+    @staticmethod
+    def range(start, stop, line):
+        # line range in the format used by unified diffs, offset by the first line of the window
+        length = stop - start
+        start = start + line + 1
+        if length == 1:
+            return str(start)
+        if length == 0:
+            start -= 1
+        return str(start)+','+str(length)
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+import time
+import itertools
+import threading
+from collections import deque
+from common import Common
+
+subscribers = []
+subscribers_lock = threading.Lock()
+event_ids = itertools.count(1)
+
+class Subscriber:
+
+    # Each subscriber has its own bounded buffer. When it is full, the oldest events are dropped
+    # instead of waiting for the subscriber, so that a slow client never stalls the pipeline.
+
+    def __init__(self, size):
+        self.events = deque(maxlen=size)
+        self.dropped = 0
+        self.condition = threading.Condition()
+
+    def put(self, event):
+        with self.condition:
+            if len(self.events) == self.events.maxlen:
+                self.dropped += 1
+            self.events.append(event)
+            self.condition.notify()
+
+    def get(self, timeout=None):
+        # returns the events published since the last call, and the number of events that were dropped,
+        # waiting up to timeout seconds for new events if there are none
+        with self.condition:
+            if not self.events:
+                self.condition.wait(timeout)
+            events = list(self.events)
+            self.events.clear()
+            dropped = self.dropped
+            self.dropped = 0
+        return events, dropped
+
+class Events:
+
+    # Progress events from running pipelines: steps starting and finishing, foreach items
+    # finishing, and test results. Published to all subscribers, like the event stream
+    # of the web interface.
+
+    @staticmethod
+    def subscribe():
+        subscriber = Subscriber(int(Common.get_config("event-queue-size", 1000)))
+        with subscribers_lock:
+            subscribers.append(subscriber)
+        return subscriber
+
+    @staticmethod
+    def unsubscribe(subscriber):
+        with subscribers_lock:
+            if subscriber in subscribers:
+                subscribers.remove(subscriber)
+
+    @staticmethod
+    def publish(type, **data):
+        with subscribers_lock:
+            if not subscribers:
+                return
+            current_subscribers = list(subscribers)
+        event = dict(data, type=type, id=next(event_ids), time=time.time())
+        for subscriber in current_subscribers:
+            subscriber.put(event)
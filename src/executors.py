@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import shlex
+import subprocess
+from common import Common
+from transfer import Transfer
+from workspace import Workspace
+from hosts import DockerHosts
+from resources import Resources
+
+class Executor:
+
+    # Runs image steps. The volumes are given as for docker, with the directories in this
+    # container and where they are mounted (/mnt/config, /mnt/input, /mnt/output and
+    # /mnt/status). Returns the exit code. The executor of a step is set with `executor`.
+    # The container or process is started when the CPUs and memory of the step are available
+    # (see Resources), and the time spent waiting is added to stats.
+
+    @staticmethod
+    def get(name):
+        return executors.get(name)
+
+    def image_id(self, step):
+        # identifies the code run by the step, for the step cache
+        raise NotImplementedError()
+
+    def run(self, step, volumes, stats=None, resources=False):
+        raise NotImplementedError()
+
+class DockerExecutor(Executor):
+
+    def image_id(self, step):
+        return Common.docker_image_id(step.id)
+
+    def run(self, step, volumes, stats=None, resources=False):
+        hosts = DockerHosts.get()
+        if hosts:
+            return hosts.run(step, volumes, stats=stats, resources=resources)
+        return Resources.get().run(step, stats, lambda: Common.docker_run(step.id, volumes, command=step.command, stats=stats, resources=resources, cpus=step.cpus, memory=step.memory))
+
+class LocalExecutor(Executor):
+
+    # Runs the entrypoint of the step as a process next to docker-pipeline, without a container.
+    # The directories are passed in environment variables instead of being mounted in /mnt,
+    # and they are not read-only, so this is only meant for trusted scripts.
+
+    variables = {
+        '/mnt/config': 'PIPELINE_CONFIG',
+        '/mnt/input': 'PIPELINE_INPUT',
+        '/mnt/output': 'PIPELINE_OUTPUT',
+        '/mnt/status': 'PIPELINE_STATUS'
+    }
+
+    def image_id(self, step):
+        return 'local:'+Common.fingerprint(os.path.dirname(step.entrypoint))
+
+    def run(self, step, volumes, stats=None, resources=False):
+        environment = dict(os.environ)
+        temp_paths = []
+        try:
+            for volume in volumes:
+                bind = volumes[volume]['bind']
+                if bind.startswith('/mnt/input/'):
+                    # a single file is mounted into /mnt/input in the container; give it a directory of its own.
+                    # It is not hardlinked, as the process could modify it.
+                    input_path = Workspace.mkdtemp('input-')
+                    temp_paths.append(input_path)
+                    Transfer.copy(volume, input_path+'/'+os.path.basename(bind), link=False)
+                    volume, bind = input_path, '/mnt/input'
+                elif not os.path.exists(volume):
+                    # docker creates missing directories that are mounted
+                    os.makedirs(volume)
+                environment[LocalExecutor.variables[bind]] = volume
+
+            return Resources.get().run(step, stats, lambda: self.run_process(step, environment, stats))
+        finally:
+            for path in temp_paths:
+                Workspace.release(path)
+
+    def run_process(self, step, environment, stats):
+        phase_start = time.time()
+        process = subprocess.Popen([step.entrypoint] + (shlex.split(step.command) if step.command else []),
+                                   cwd=os.path.dirname(step.entrypoint), env=environment,
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        for line in process.stdout:
+            Common.message(line.decode('utf-8', 'replace').rstrip('\n'))
+        exit_code = process.wait()
+        if stats is not None:
+            stats['run'] = time.time() - phase_start
+        return exit_code
+
+executors = {
+    'docker': DockerExecutor(),
+    'local': LocalExecutor()
+}
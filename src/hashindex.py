@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from common import Common
+
+global hash_index
+hash_index = None
+hash_index_lock = threading.Lock()
+
+class HashIndex:
+
+    # Remembers the hashes of files that are not expected to change (the test fixtures), so that
+    # they only need to be hashed again if their size, modification time or inode changes.
+    # Persisted to hash-index if configured, otherwise only kept in memory.
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = Common.load_json(path, {}) if path else {}
+        self.changed = False
+
+    @staticmethod
+    def get():
+        global hash_index
+        with hash_index_lock:
+            if hash_index is None:
+                hash_index = HashIndex(Common.get_config("hash-index", None))
+        return hash_index
+
+    @staticmethod
+    def list_files(path):
+        # relative path => full path and size, for all files in path (or path itself if it is a file)
+        files = {}
+        if os.path.isdir(path):
+            for root, subdirs, filenames in os.walk(path):
+                for file in filenames:
+                    fullpath = os.path.join(root, file)
+                    files[os.path.relpath(root, path)+'/'+file] = { 'fullpath': fullpath, 'size': os.path.getsize(fullpath) }
+        else:
+            files['./'+os.path.basename(path)] = { 'fullpath': path, 'size': os.path.getsize(path) }
+        return files
+
+    def hashfile(self, path):
+        stat = os.stat(path)
+        key = os.path.abspath(path)
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns and entry['inode'] == stat.st_ino:
+            return bytes.fromhex(entry['hash'])
+        digest = Common.hashfile(path)
+        with self.lock:
+            self.entries[key] = { 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'inode': stat.st_ino, 'hash': digest.hex() }
+            self.changed = True
+        return digest
+
+    def hashfiles(self, paths, indexed_paths=()):
+        # hashes paths directly, and indexed_paths through the index, using hash-workers threads
+        indexed_paths = set(indexed_paths)
+        start_time = time.time()
+        def hash_path(path):
+            return path, self.hashfile(path) if path in indexed_paths else Common.hashfile(path)
+        with ThreadPoolExecutor(max_workers=int(Common.get_config("hash-workers", 4))) as executor:
+            hashes = dict(executor.map(hash_path, set(paths) | indexed_paths))
+        Common.add_timing('hash', time.time() - start_time)
+        self.save()
+        return hashes
+
+    def save(self):
+        with self.lock:
+            if self.path and self.changed:
+                Common.save_json(self.path, self.entries)
+                self.changed = False
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import shutil
+import threading
+import docker
+import requests
+from common import Common
+from resources import Resources
+
+global hosts
+hosts = None
+hosts_lock = threading.Lock()
+
+class DockerHost:
+
+    # A docker daemon in docker-hosts. With shared, the daemon sees the same files at the same
+    # paths as the local daemon (for instance through a network file system), so the volumes
+    # can be mounted. Otherwise they are copied into and out of each container. The CPUs and
+    # memory of the containers on the host are limited by cpus (default: the number of CPUs
+    # of the daemon) and memory (default: no limit).
+
+    def __init__(self, url, workers=1, shared=True, client=None, cpus=None, memory=None):
+        self.url = url
+        self.workers = workers
+        self.shared = shared
+        self.client = client or docker.Client(base_url=url)
+        self.cpus = cpus
+        self.memory = memory
+        self.resources = None
+        self.running = 0
+        self.failed_until = 0.0
+        self.images = {}  # dockerfile directory or image name => image ID on this host
+        self.images_lock = threading.Lock()
+
+    def image_id(self, step):
+        # the image for the step on this host. Dockerfiles are built on each host, and
+        # images that are missing on the host are pulled.
+        key = step.build_path or step.id
+        with self.images_lock:
+            if not key in self.images:
+                if step.build_path:
+                    image_id = Common.docker_build(step.build_path, client=self.client)
+                    if not image_id:
+                        raise docker.errors.DockerException("unable to build "+step.build_path+" on "+self.url)
+                else:
+                    try:
+                        Common.docker_call('inspect_image', step.id, client=self.client)
+                    except docker.errors.APIError:
+                        Common.message("Pulling docker image on "+self.url+": "+step.id)
+                        Common.docker_call('pull', step.id, client=self.client)
+                    image_id = step.id
+                self.images[key] = image_id
+            return self.images[key]
+
+    def budget(self):
+        # the Resources of this host; the number of CPUs is asked from the daemon unless it is configured
+        with self.images_lock:
+            if self.resources is None:
+                cpus = self.cpus
+                if cpus is None:
+                    cpus = Common.docker_call('info', client=self.client).get('NCPU') or 1
+                self.resources = Resources(float(cpus), self.memory)
+            return self.resources
+
+class DockerHosts:
+
+    # Spreads the containers over the docker daemons in docker-hosts. Each container is run on the
+    # host with the lowest load (running containers per worker) that has a free worker. A host
+    # that fails is not used again for docker-host-retry seconds, and the container is retried
+    # on another host. Foreach items are spread over the hosts when foreach-workers allows
+    # several items to run at once.
+
+    def __init__(self, hosts, retry_interval=60.0):
+        self.hosts = hosts
+        self.retry_interval = retry_interval
+        self.condition = threading.Condition()
+
+    @staticmethod
+    def get():
+        # None unless docker-hosts is set
+        global hosts
+        with hosts_lock:
+            if hosts is None:
+                pool = []
+                for host in Common.get_config("docker-hosts", None) or []:
+                    if isinstance(host, str):
+                        host = { 'url': host }
+                    pool.append(DockerHost(host['url'], workers=int(host.get('workers', 1)), shared=bool(host.get('shared', True)),
+                                           cpus=float(host['cpus']) if host.get('cpus') else None,
+                                           memory=Common.parse_size(host['memory']) if host.get('memory') else None))
+                hosts = DockerHosts(pool, retry_interval=float(Common.get_config("docker-host-retry", 60)))
+        return hosts if hosts.hosts else None
+
+    def acquire(self, exclude):
+        # the host to run the next container on, or None if all hosts are excluded
+        with self.condition:
+            while True:
+                candidates = [ host for host in self.hosts if not host in exclude ]
+                if not candidates:
+                    return None
+                now = time.time()
+                # failed hosts are only used if all the other hosts have failed as well
+                healthy = [ host for host in candidates if host.failed_until <= now ] or candidates
+                available = [ host for host in healthy if host.running < host.workers ]
+                if available:
+                    host = min(available, key=lambda host: float(host.running) / host.workers)
+                    host.running += 1
+                    return host
+                self.condition.wait(1.0)
+
+    def release(self, host, failed=False):
+        with self.condition:
+            host.running -= 1
+            if failed:
+                host.failed_until = time.time() + self.retry_interval
+            self.condition.notify_all()
+
+    def run(self, step, volumes, stats=None, resources=False):
+        # runs the container of an image step on one of the hosts, and on another host if that one fails
+        tried = set()
+        error = None
+        while True:
+            host = self.acquire(exclude=tried)
+            if host is None:
+                raise error
+            failed = False
+            try:
+                if tried:
+                    # clear the output from the failed attempt
+                    for volume in volumes:
+                        if volumes[volume]['mode'] != 'ro':
+                            shutil.rmtree(volume, ignore_errors=True)
+                            os.makedirs(volume)
+                image_id = host.image_id(step)
+                def run_container():
+                    return Common.docker_run(image_id, volumes, command=step.command, stats=stats, resources=resources,
+                                             client=host.client, staged=not host.shared, cpus=step.cpus, memory=step.memory)
+                if step.cpus or step.memory:
+                    # admitted within the budget of the host it was placed on
+                    return host.budget().run(step, stats, run_container)
+                return run_container()
+            except requests.exceptions.RequestException as e:
+                # errors in the request itself (such as a missing image or a bad command) would fail on any host
+                if isinstance(e, docker.errors.APIError) and not e.is_server_error():
+                    raise
+                Common.message(step.padding+"   WARNING: docker host failed: "+host.url+": "+str(e))
+                failed = True
+                tried.add(host)
+                error = e
+            finally:
+                self.release(host, failed=failed)
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import queue
+import shutil
+import threading
+from common import Common
+from journal import Journal, RunCancelled
+
+class Jobs:
+
+    # Runs submitted through the web interface or the watch mode. Each job is a journaled run of
+    # the pipeline that is already loaded, so that the docker images are only built once. The jobs
+    # are run by a fixed number of worker threads, and the list of jobs is saved to <name>.json in
+    # runs-dir, so that queued and interrupted jobs are started again (resuming from the journal)
+    # after a restart. If given, finished is called with the job when it is no longer running.
+    # Unless keep is set, the job and the directory of its run are removed after that.
+
+    def __init__(self, pipeline, workers=2, name="jobs", finished=None, keep=True):
+        self.pipeline = pipeline
+        self.finished = finished
+        self.keep = keep
+        self.path = os.path.join(Journal.runs_dir(), name+".json")
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.journals = {}  # job ID => journal, for jobs that are queued or running
+        self.jobs = Common.load_json(self.path, {})
+        for job_id in sorted(self.jobs, key=lambda job_id: self.jobs[job_id]['submitted']):
+            if self.jobs[job_id]['state'] in ['queued', 'running']:
+                journal = Journal.open(job_id)
+                if journal:
+                    self.jobs[job_id]['state'] = 'queued'
+                    self.journals[job_id] = journal
+                    self.queue.put(job_id)
+                else:
+                    self.jobs[job_id]['state'] = 'failed'
+                    self.jobs[job_id]['error'] = "the directory of the run is missing"
+        self.save()
+        if not self.keep:
+            # jobs that were done when the process was stopped, before they were removed
+            for job_id in [ job_id for job_id in self.jobs if not job_id in self.journals ]:
+                self.done(job_id)
+        for worker in range(workers):
+            thread = threading.Thread(target=self.work, name='job-worker-'+str(worker))
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, input_path, output_path=None):
+        journal = Journal.create(input_path, output_path, config_path="/mnt/config" if os.path.isdir("/mnt/config") else None)
+        with self.lock:
+            self.jobs[journal.run_id] = {
+                'id': journal.run_id,
+                'state': 'queued',
+                'input': journal.info['input'],
+                'output': journal.info['output'],
+                'status_path': journal.info['status'],
+                'submitted': time.time(),
+                'started': None,
+                'finished': None,
+                'error': None
+            }
+            self.journals[journal.run_id] = journal
+            self.save()
+        self.queue.put(journal.run_id)
+        return self.get(journal.run_id)
+
+    def get(self, job_id):
+        with self.lock:
+            if not job_id in self.jobs:
+                return None
+            job = dict(self.jobs[job_id])
+        job['status'] = Common.first_line(job['status_path'])
+        job['host_output'] = Common.host_path(job['output'])
+        return job
+
+    def list(self):
+        with self.lock:
+            job_ids = sorted(self.jobs, key=lambda job_id: self.jobs[job_id]['submitted'])
+        return [ self.get(job_id) for job_id in job_ids ]
+
+    def active(self):
+        # the number of jobs that are queued or running
+        with self.lock:
+            return len(self.journals)
+
+    def cancel(self, job_id):
+        # queued jobs are not started, and running jobs stop before their next step
+        with self.lock:
+            if not job_id in self.jobs:
+                return None
+            cancelled = False
+            if self.jobs[job_id]['state'] in ['queued', 'running']:
+                self.journals[job_id].cancel()
+                if self.jobs[job_id]['state'] == 'queued':
+                    self.jobs[job_id]['state'] = 'cancelled'
+                    self.jobs[job_id]['finished'] = time.time()
+                    del self.journals[job_id]
+                    self.save()
+                    cancelled = True
+        job = self.get(job_id)
+        if cancelled:
+            self.done(job_id)
+        return job
+
+    def work(self):
+        while True:
+            job_id = self.queue.get()
+            with self.lock:
+                if not job_id in self.jobs or self.jobs[job_id]['state'] != 'queued':
+                    continue
+                journal = self.journals[job_id]
+                self.jobs[job_id]['state'] = 'running'
+                self.jobs[job_id]['started'] = time.time()
+                self.save()
+
+            error = None
+            try:
+                self.pipeline.run_journaled(journal)
+                state = 'finished'
+            except RunCancelled:
+                Common.message("Job cancelled: "+job_id)
+                state = 'cancelled'
+            except Exception as e:
+                Common.message("ERROR: job failed: "+job_id+": "+str(e))
+                state = 'failed'
+                error = str(e)
+
+            with self.lock:
+                self.jobs[job_id]['state'] = state
+                self.jobs[job_id]['finished'] = time.time()
+                self.jobs[job_id]['error'] = error
+                del self.journals[job_id]
+                self.save()
+            self.done(job_id)
+
+    def done(self, job_id):
+        # called when the job is no longer running
+        if self.finished:
+            self.finished(self.get(job_id))
+        if not self.keep:
+            with self.lock:
+                del self.jobs[job_id]
+                self.save()
+            shutil.rmtree(os.path.join(Journal.runs_dir(), job_id), ignore_errors=True)
+
+    def save(self):
+        Common.save_json(self.path, self.jobs)
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+from common import Common
+
+class RunCancelled(Exception):
+    pass
+
+class Journal:
+
+    # Records which steps of a run have completed, so that the run can be resumed after a crash.
+    # Each run has its own directory in runs-dir, containing run.json with the arguments of the
+    # run, journal.jsonl with one line per completed step, and the intermediate directories of
+    # the steps, which have predictable names and are kept until the whole run has finished.
+    # A completed step is skipped when resuming if its input has the same fingerprint as before.
+
+    def __init__(self, path):
+        self.path = path
+        self.run_id = os.path.basename(path)
+        self.lock = threading.Lock()
+        self.cancelled = threading.Event()
+        self.info = Common.load_json(path+"/run.json", {})
+        self.entries = {}
+        if os.path.exists(path+"/journal.jsonl"):
+            with open(path+"/journal.jsonl", 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # the last line may be incomplete if the process was killed while writing it
+                    self.entries[entry['step_id']] = entry
+
+    @staticmethod
+    def runs_dir():
+        runs_dir = Common.get_config("runs-dir", None)
+        if not runs_dir:
+            runs_dir = os.path.join(Common.get_config("work-dir", None) or tempfile.gettempdir(), "runs")
+        return runs_dir
+
+    @staticmethod
+    def create(input_path, output_path=None, config_path=None):
+        # without an output path, the output is stored in the directory of the run
+        runs_dir = Journal.runs_dir()
+        if not os.path.isdir(runs_dir):
+            os.makedirs(runs_dir)
+        path = tempfile.mkdtemp(prefix='run-', dir=runs_dir)
+        os.makedirs(path+"/status")
+        Common.save_json(path+"/run.json", {
+            'input': os.path.abspath(input_path),
+            'output': os.path.abspath(output_path) if output_path else path+"/output",
+            'status': path+"/status",
+            'config': config_path,
+            'finished': False
+        })
+        return Journal(path)
+
+    @staticmethod
+    def open(run_id):
+        path = os.path.join(Journal.runs_dir(), run_id)
+        if not os.path.exists(path+"/run.json"):
+            return None
+        return Journal(path)
+
+    def temp_path(self, step_id):
+        # the directory for the intermediate results of the (sub-)pipeline with the given step ID
+        return self.path+"/steps/"+hashlib.sha1(step_id.encode('utf-8')).hexdigest()[:16]
+
+    def completed_step(self, step_id, input_path):
+        # the journal entry for the step, or None if it has to be run (again)
+        with self.lock:
+            entry = self.entries.get(step_id)
+        if entry is None or entry['input'] != Common.fingerprint(input_path):
+            return None
+        return entry
+
+    def complete(self, step_id, input_path, output_path, status_path, exit=False):
+        entry = {
+            'step_id': step_id,
+            'input': Common.fingerprint(input_path),
+            'output': output_path,
+            'status': status_path,
+            'exit': exit
+        }
+        with self.lock:
+            self.entries[step_id] = entry
+            with open(self.path+"/journal.jsonl", 'a') as f:
+                f.write(json.dumps(entry)+"\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def start(self):
+        # called at the start of each attempt to run it
+        with self.lock:
+            self.info['attempts'] = self.info.get('attempts', 0) + 1
+            Common.save_json(self.path+"/run.json", self.info)
+
+    def resumed(self):
+        # whether an earlier attempt may have left partial results behind
+        return self.info.get('attempts', 1) > 1
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def check_cancelled(self):
+        # called between steps, so that a cancelled run stops before starting another step
+        if self.cancelled.is_set():
+            raise RunCancelled(self.run_id)
+
+    def finish(self):
+        with self.lock:
+            shutil.rmtree(self.path+"/steps", ignore_errors=True)
+            self.info['finished'] = True
+            Common.save_json(self.path+"/run.json", self.info)
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import json
+import time
+import queue
+import threading
+from slacker import Slacker
+
+class MessageSink:
+
+    # A destination for log messages. Each sink has its own queue and background thread,
+    # so that a slow sink (like Slack) never blocks the pipeline or the other sinks.
+    # Messages are written in batches; with an interval, messages arriving in between
+    # writes are coalesced into the next batch.
+
+    def __init__(self, interval=0.0, queue_size=10000, drop=False, max_batch=1000):
+        self.interval = interval
+        self.drop = drop
+        self.max_batch = max_batch
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.dropped = 0
+        self.dropped_lock = threading.Lock()
+        self.thread = threading.Thread(target=self.loop, name=self.__class__.__name__)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, message):
+        if not self.drop:
+            self.queue.put(message)
+            return
+        try:
+            self.queue.put_nowait(message)
+        except queue.Full:
+            with self.dropped_lock:
+                self.dropped += 1
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def loop(self):
+        last_write = 0.0
+        closed = False
+        while not closed:
+            message = self.queue.get()
+            if message is None:
+                break
+            batch = [message]
+            deadline = last_write + self.interval
+            while len(batch) < self.max_batch:
+                try:
+                    message = self.queue.get(timeout=max(0.0, deadline - time.time())) if time.time() < deadline else self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if message is None:
+                    closed = True
+                    break
+                batch.append(message)
+            with self.dropped_lock:
+                if self.dropped:
+                    batch.append("("+str(self.dropped)+" messages were dropped)")
+                    self.dropped = 0
+            try:
+                self.write(batch)
+            except Exception as e:
+                sys.stderr.write("Unable to write messages to "+self.__class__.__name__+": "+str(e)+"\n")
+            last_write = time.time()
+
+    def write(self, messages):
+        raise NotImplementedError()
+
+class StdoutSink(MessageSink):
+
+    def write(self, messages):
+        for message in messages:
+            print(message)
+        sys.stdout.flush()
+
+class SlackSink(MessageSink):
+
+    def __init__(self, token, channel, botname, interval=1.0, queue_size=1000):
+        self.slack = Slacker(token)
+        self.channel = channel
+        self.botname = botname
+        MessageSink.__init__(self, interval=interval, queue_size=queue_size, drop=True, max_batch=100)
+
+    def write(self, messages):
+        self.slack.chat.post_message(self.channel, "\n".join(messages), self.botname)
+
+class JsonLinesSink(MessageSink):
+
+    def __init__(self, path, queue_size=10000):
+        self.path = path
+        MessageSink.__init__(self, queue_size=queue_size)
+
+    def write(self, messages):
+        with open(self.path, 'a') as f:
+            for message in messages:
+                f.write(json.dumps({ 'time': time.time(), 'message': message })+"\n")
+
+class Messages:
+
+    def __init__(self, sinks):
+        self.sinks = sinks
+
+    def put(self, message):
+        if isinstance(message, bytes):
+            message = message.decode('utf-8', 'replace').rstrip("\n")
+        elif not isinstance(message, str):
+            message = str(message)
+        for sink in self.sinks:
+            sink.put(message)
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+        self.sinks = []
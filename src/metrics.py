@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+import json
+import time
+import atexit
+import threading
+from common import Common
+from messages import MessageSink
+from transfer import Transfer
+from cache import StepCache
+
+global metrics
+metrics = None
+metrics_lock = threading.Lock()
+
+class MetricsSink(MessageSink):
+
+    def __init__(self, path, queue_size=10000):
+        self.path = path
+        MessageSink.__init__(self, queue_size=queue_size)
+
+    def write(self, records):
+        with open(self.path, 'a') as f:
+            for record in records:
+                f.write(json.dumps(record)+"\n")
+
+class Metrics:
+
+    # Measurements for each step and each foreach item. The records are written as JSON lines
+    # to metrics-log if configured, and summed up for the /metrics page of the web interface.
+    # Counting the files in the input and output of each step and sampling the resource usage
+    # of the containers is only done if metrics is enabled (default: when metrics-log is set).
+
+    def __init__(self, path=None, detailed=False):
+        self.detailed = detailed
+        self.sink = MetricsSink(path) if path else None
+        self.lock = threading.Lock()
+        self.steps = {}  # (location, type, name) => totals
+        self.items = {}  # location => totals
+        if self.sink:
+            atexit.register(self.sink.close)
+
+    @staticmethod
+    def get():
+        global metrics
+        with metrics_lock:
+            if metrics is None:
+                path = Common.get_config("metrics-log", None)
+                metrics = Metrics(path, detailed=bool(Common.get_config("metrics", bool(path))))
+        return metrics
+
+    def step(self, record, start_time, input_path, output_path, success):
+        # records a step that has finished; record contains the step ID, location, type and name, and for
+        # image steps the exit code, whether the result was cached, the queue wait and the container timings
+        record['time'] = start_time
+        record['seconds'] = time.time() - start_time
+        record['success'] = success
+        if self.detailed:
+            record['input_files'], record['input_bytes'] = Common.tree_stats(input_path) if input_path else (0, 0)
+            record['output_files'], record['output_bytes'] = Common.tree_stats(output_path) if output_path else (0, 0)
+
+        with self.lock:
+            key = (record['location'], record['type'], record['name'])
+            if not key in self.steps:
+                self.steps[key] = { 'runs': 0, 'failures': 0, 'cached': 0, 'seconds': 0.0, 'container': {},
+                                    'input_bytes': 0, 'output_bytes': 0, 'input_files': 0, 'output_files': 0,
+                                    'peak_memory': 0, 'peak_cpu': 0.0, 'queue_seconds': 0.0 }
+            totals = self.steps[key]
+            totals['runs'] += 1
+            totals['failures'] += 0 if success else 1
+            totals['cached'] += 1 if record.get('cached') else 0
+            totals['seconds'] += record['seconds']
+            totals['queue_seconds'] += record.get('queue_seconds', 0.0)
+            for phase in ['create', 'start', 'run', 'remove']:
+                if phase in record.get('container', {}):
+                    totals['container'][phase] = totals['container'].get(phase, 0.0) + record['container'][phase]
+            for key in ['input_bytes', 'output_bytes', 'input_files', 'output_files']:
+                totals[key] += record.get(key, 0)
+            totals['peak_memory'] = max(totals['peak_memory'], record.get('container', {}).get('peak_memory', 0))
+            totals['peak_cpu'] = max(totals['peak_cpu'], record.get('container', {}).get('peak_cpu', 0.0))
+
+        if self.sink:
+            self.sink.put(record)
+
+    def item(self, location, step_id, item, start_time, items=1):
+        # records a foreach item (or a batch of items) that has been run through the sub-pipeline
+        record = { 'time': start_time, 'seconds': time.time() - start_time, 'type': 'item', 'step_id': step_id, 'location': location, 'item': item, 'items': items }
+        with self.lock:
+            if not location in self.items:
+                self.items[location] = { 'items': 0, 'seconds': 0.0 }
+            self.items[location]['items'] += items
+            self.items[location]['seconds'] += record['seconds']
+        if self.sink:
+            self.sink.put(record)
+
+    def prometheus(self):
+        # the metrics in the Prometheus text format
+        lines = []
+        def metric(name, kind, help, samples):
+            lines.append('# HELP docker_pipeline_'+name+' '+help)
+            lines.append('# TYPE docker_pipeline_'+name+' '+kind)
+            for labels, value in samples:
+                label_text = ','.join([label+'="'+Metrics.escape(labels[label])+'"' for label in sorted(labels)])
+                lines.append('docker_pipeline_'+name+('{'+label_text+'}' if label_text else '')+' '+repr(float(value)))
+
+        with self.lock:
+            steps = [ (dict(location=key[0], type=key[1], name=key[2]), dict(self.steps[key], container=dict(self.steps[key]['container']))) for key in sorted(self.steps) ]
+            items = [ (dict(location=location), dict(self.items[location])) for location in sorted(self.items) ]
+
+        metric('step_runs_total', 'counter', 'Number of times each step has been run.', [ (labels, totals['runs']) for labels, totals in steps ])
+        metric('step_failures_total', 'counter', 'Number of times each step has failed.', [ (labels, totals['failures']) for labels, totals in steps ])
+        metric('step_cached_total', 'counter', 'Number of times the result of each step was restored from the step cache.', [ (labels, totals['cached']) for labels, totals in steps ])
+        metric('step_seconds_total', 'counter', 'Time spent running each step.', [ (labels, totals['seconds']) for labels, totals in steps ])
+        metric('step_queue_seconds_total', 'counter', 'Time each step has waited for CPUs and memory before its container could start.', [ (labels, totals['queue_seconds']) for labels, totals in steps ])
+        metric('step_container_seconds_total', 'counter', 'Time spent in each phase of the containers of each step.',
+               [ (dict(labels, phase=phase), totals['container'][phase]) for labels, totals in steps for phase in sorted(totals['container']) ])
+        if self.detailed:
+            for key, help in [('input_bytes', 'Bytes in the input of each step.'), ('output_bytes', 'Bytes in the output of each step.'),
+                              ('input_files', 'Files in the input of each step.'), ('output_files', 'Files in the output of each step.')]:
+                metric('step_'+key+'_total', 'counter', help, [ (labels, totals[key]) for labels, totals in steps ])
+            metric('step_peak_memory_bytes', 'gauge', 'Highest memory usage of a container of each step.', [ (labels, totals['peak_memory']) for labels, totals in steps ])
+            metric('step_peak_cpu_percent', 'gauge', 'Highest CPU usage of a container of each step, in percent of one CPU.', [ (labels, totals['peak_cpu']) for labels, totals in steps ])
+        metric('foreach_items_total', 'counter', 'Number of items processed by each foreach step.', [ (labels, totals['items']) for labels, totals in items ])
+        metric('foreach_item_seconds_total', 'counter', 'Time spent processing the items of each foreach step.', [ (labels, totals['seconds']) for labels, totals in items ])
+
+        timings = Common.timings()
+        metric('activity_seconds_total', 'counter', 'Time spent building images, hashing files and transferring files.', [ (dict(activity=activity), timings[activity]) for activity in sorted(timings) ])
+        docker_api_stats = Common.docker_api_stats()
+        metric('docker_api_calls_total', 'counter', 'Number of requests to the docker daemon.', [ (dict(method=method), docker_api_stats[method]['calls']) for method in sorted(docker_api_stats) ])
+        metric('docker_api_seconds_total', 'counter', 'Time spent waiting for the docker daemon.', [ (dict(method=method), docker_api_stats[method]['seconds']) for method in sorted(docker_api_stats) ])
+        transfer_stats = Transfer.stats()
+        metric('transferred_bytes_total', 'counter', 'Bytes moved or copied between step directories.', [ (dict(method=method), transfer_stats[method]) for method in sorted(transfer_stats) ])
+        cache = StepCache.get()
+        if cache:
+            metric('cache_hits_total', 'counter', 'Number of step cache hits.', [ ({}, cache.hits) ])
+            metric('cache_misses_total', 'counter', 'Number of step cache misses.', [ ({}, cache.misses) ])
+        return "\n".join(lines)+"\n"
+
+    @staticmethod
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -1,191 +1,308 @@
 # -*- coding: utf-8 -*-
 
 import os
-import tempfile
+import shutil
+import itertools
+import time
 from pprint import pprint
 from common import Common
-import mimetypes
-import difflib
-import shutil
+from cache import StepCache
+from transfer import Transfer
+from workspace import Workspace
+from hashindex import HashIndex
+from diff import Diff
+from metrics import Metrics
+from events import Events
+from executors import Executor
+from steps import ExitStep, ImageStep, UnfoldStep, TestStep, Choice, ChooseStep, ForeachStep, Branch, ParallelStep
 
 class Pipeline:
     
-    def __init__(self, path, host_path, pipeline=None, start_location=None):
+    def __init__(self, path, host_path, pipeline=None, start_location=None, depth=0):
         self.path = path
         self.host_path = host_path
+        self.depth = depth
         if pipeline:
             self.pipeline = pipeline
         else:
             Common.message("host_path: "+host_path)
-            self.pipeline = Common.load_yaml(path)
+            self.pipeline = Common.load_yaml(path, cache_path=Common.get_config("pipeline-cache", None))
         if start_location:
             self.location = start_location
         elif '__location__' in self.pipeline:
             self.location = self.pipeline['__location__']
         else:
-            os.path.basename(self.path)+":1"
+            self.location = os.path.basename(self.path)+":1"
         self.steps = []
         self.tests = {}
+        self.builds = []
+        self.last_test_steps = {}
         for step in self.pipeline['pipeline']:
             if isinstance(step, str):
                 if step == "exit":
-                    self.steps.append({ 'exit': { 'location': self.location.split(':',1)[0] }})
+                    self.steps.append(ExitStep(self.location.split(':',1)[0], depth))
                 else:
                     Common.message("WARNING: unknown instruction found: '"+step+"' (skipping!)")
                 continue
             
             step_line = [key for key in list(step.keys()) if not key.startswith('_')]
             step_line = None if len(step_line) == 0 else step_line[0]
+            location = str(step['__location__'])
             
             if 'image' in step:
-                image = { 'location': str(step['__location__']), 'name': step['image'], 'id': step['image'] }
-                if 'command' in step:
-                    image['command'] = step['command']
-                self.steps.append({ 'image': image })
+                self.steps.append(ImageStep(location, depth, step['image'], step['image'], command=step.get('command'), cache=bool(step.get('cache', True)), **self.executor(step)))
             
             elif 'dockerfile' in step:
-                image_id = Common.docker_build(os.path.dirname(path)+"/"+step['dockerfile']+"/")
-                image = { 'location': str(step['__location__']), 'name': step['dockerfile'], 'id': image_id }
-                if 'command' in step:
-                    image['command'] = step['command']
-                self.steps.append({ 'image': image })
+                image = ImageStep(location, depth, step['dockerfile'], None, build_path=os.path.dirname(path)+"/"+step['dockerfile']+"/", command=step.get('command'), cache=bool(step.get('cache', True)), **self.executor(step))
+                if image.executor == 'docker':
+                    self.builds.append((image, Common.docker_build_async(image.build_path)))
+                self.steps.append(image)
                 
             elif 'unfold' in step:
-                self.steps.append({'unfold':{'location': str(step['__location__']), 'name':'unfold', 'depth':step['unfold']}})
+                self.steps.append(UnfoldStep(location, depth, step['unfold']))
             
             elif 'test' in step:
                 test_input = '*' if not 'input' in step['test'] else step['test']['input']
-                test = { 'location': str(step['__location__']), 'name': test_input }
-                for key in ['input', 'expect', 'status', 'focus', 'context']:
+                test = {}
+                for key in TestStep.keys:
                     if key in step['test']:
                         test[key] = step['test'][key]
-                
-                if not test_input in self.tests:
-                    self.tests[test_input] = {}
-                self.tests[test_input][str(len(self.steps))] = test
-                self.steps.append({ 'test': test })
+                if 'status' in test and test['status'] is None:
+                    test['status'] = ''
+                self.add_test(test_input, TestStep(location, depth, test_input, **test))
             
             elif 'assert' in step:
-                assertion = { 'test': { 'location': str(step['__location__']), 'name': '*', 'input': '*', 'status': step['assert'] if not step['assert'] == None else "" }}
-                if not '*' in self.tests:
-                    self.tests['*'] = {}
-                self.tests['*'][str(len(self.steps))] = assertion['test']
-                self.steps.append(assertion)
+                self.add_test('*', TestStep(location, depth, '*', input='*', status=step['assert'] if not step['assert'] == None else ""))
             
             elif step_line.startswith('if'):
                 test = step_line[2:].split(":",1)[0].strip()
-                subpipeline_name = 'pipeline' if not 'name' in self.pipeline['pipeline'] else self.pipeline['pipeline']['name']
-                subpipeline_if = Pipeline(
-                                           self.path,
-                                           self.host_path,
-                                           pipeline={
-                                               'name': subpipeline_name,
-                                               'pipeline': step[step_line]
-                                           },
-                                           start_location=step['__location__']
-                                       )
-                subpipeline_else = Pipeline(
-                                           self.path,
-                                           self.host_path,
-                                           pipeline={
-                                               'name': subpipeline_name,
-                                               'pipeline': []
-                                           },
-                                           start_location=step['__location__']
-                                       )
-                for test_input in subpipeline_if.tests:
-                    if not test_input in self.tests:
-                        self.tests[test_input] = {}
-                    for subtest_id in subpipeline_if.tests[test_input]:
-                        self.tests[test_input][str(len(self.steps))+'.'+subtest_id] = subpipeline_if.tests[test_input][subtest_id]
-                self.steps.append({ 'choose':
-                                    { 'location': str(step['__location__']),
-                                      'choices': [
-                                        { 'when': {
-                                            'location': str(step['__location__']),
-                                            'test': test,
-                                            'pipeline': subpipeline_if
-                                        }},
-                                        { 'otherwise': {
-                                            'location': str(step['__location__']),
-                                            'pipeline': subpipeline_else
-                                        }}
-                                      ]
-                                    }
-                                  })
+                choices = [ Choice(location, test, self.subpipeline(step[step_line], step['__location__'], len(self.steps))),
+                            Choice(location, None, self.subpipeline([], step['__location__'], len(self.steps))) ]
+                self.steps.append(ChooseStep(location, depth, choices))
             
             elif step_line.startswith('elif'):
                 choose = self.steps[len(self.steps)-1]
                 test = step_line[4:].split(":",1)[0].strip()
-                subpipeline_name = 'pipeline' if not 'name' in self.pipeline['pipeline'] else self.pipeline['pipeline']['name']
-                subpipeline_elif = Pipeline(
-                                           self.path,
-                                           self.host_path,
-                                           pipeline={
-                                               'name': subpipeline_name,
-                                               'pipeline': step[step_line]
-                                           },
-                                           start_location=step['__location__']
-                                       )
-                for test_input in subpipeline_elif.tests:
-                    if not test_input in self.tests:
-                        self.tests[test_input] = {}
-                    for subtest_id in subpipeline_elif.tests[test_input]:
-                        self.tests[test_input][str(len(self.steps))+'.'+subtest_id] = subpipeline_elif.tests[test_input][subtest_id]
-                when = { 'when': { 'location': str(step['__location__']), 'test': test, 'pipeline': subpipeline_elif } }
-                choose['choose']['choices'].insert(len(choose['choose']['choices'])-1, when)
+                choose.choices.insert(len(choose.choices)-1, Choice(location, test, self.subpipeline(step[step_line], step['__location__'], len(self.steps)-1)))
             
             elif 'else' in step:
                 choose = self.steps[len(self.steps)-1]
-                subpipeline_name = 'pipeline' if not 'name' in self.pipeline['pipeline'] else self.pipeline['pipeline']['name']
-                subpipeline_else = Pipeline(
-                                           self.path,
-                                           self.host_path,
-                                           pipeline={
-                                               'name': subpipeline_name,
-                                               'pipeline': step['else']
-                                           },
-                                           start_location=step['__location__']
-                                       )
-                for test_input in subpipeline_else.tests:
-                    if not test_input in self.tests:
-                        self.tests[test_input] = {}
-                    for subtest_id in subpipeline_else.tests[test_input]:
-                        self.tests[test_input][str(len(self.steps))+'.'+subtest_id] = subpipeline_else.tests[test_input][subtest_id]
-                otherwise = { 'otherwise': { 'location': str(step['__location__']), 'pipeline': subpipeline_else } }
-                choose['choose']['choices'][len(choose['choose']['choices'])-1] = otherwise
+                choose.choices[len(choose.choices)-1] = Choice(location, None, self.subpipeline(step['else'], step['__location__'], len(self.steps)-1))
             
             elif 'foreach' in step:
-                subpipeline_name = 'pipeline' if not 'name' in self.pipeline['pipeline'] else self.pipeline['pipeline']['name']
-                subpipeline = Pipeline(
-                                           self.path,
-                                           self.host_path,
-                                           pipeline={
-                                               'name': subpipeline_name,
-                                               'pipeline': step['foreach']
-                                           },
-                                           start_location=step['__location__']
-                                       )
-                for test_input in subpipeline.tests:
-                    if not test_input in self.tests:
-                        self.tests[test_input] = {}
-                    for subtest_id in subpipeline.tests[test_input]:
-                        self.tests[test_input][str(len(self.steps))+'.'+subtest_id] = subpipeline.tests[test_input][subtest_id]
-                self.steps.append({ 'foreach': { 'location': str(step['__location__']), 'name': subpipeline_name, 'pipeline': subpipeline }})
+                subpipeline = self.subpipeline(step['foreach'], step['__location__'], len(self.steps))
+                batch = int(step['batch']) if 'batch' in step else None
+                if batch and (subpipeline.step_count == 0 or [substep for substep in subpipeline.steps if substep.type != 'image']):
+                    Common.message("WARNING: batch is only supported for foreach steps that only contain image steps (running the items one by one): "+location)
+                    batch = None
+                self.steps.append(ForeachStep(location, depth, subpipeline.name, subpipeline, workers=int(step['workers']) if 'workers' in step else None, batch=batch))
+            
+            elif 'parallel' in step:
+                branch_names = [ name for name in step['parallel'] if not str(name).startswith('_') ]
+                branches = [ Branch(location, str(name), self.subpipeline(step['parallel'][name], step['__location__'], len(self.steps), branch=branch_position))
+                             for branch_position, name in enumerate(branch_names) ]
+                self.steps.append(ParallelStep(location, depth, branches, workers=int(step['workers']) if 'workers' in step else None))
             
             else:
                 Common.message("WARNING: unknown step type: dictionary with key '"+step_line+"' (skipping!)")
-
-    def run(self, config_path, input_path, output_path, status_path, status="", test=None, step_id='', step_depth=0):
-        temp_path = tempfile.mkdtemp(prefix='pipeline-')
         
+        position = 0
+        for step in self.steps:
+            if step.type != 'test':
+                step.position = position
+                position += 1
+        self.step_count = position
+        self.padding = (self.location if len(self.steps) == 0 else self.steps[0].location).ljust(20+depth*2)
+        
+        if not start_location:
+            # wait for the docker images to be built, now that the whole pipeline has been read
+            for image, build in self.builds:
+                image.id = build.result()
+            self.builds = []
+    
+    @property
+    def name(self):
+        return 'pipeline' if not 'name' in self.pipeline['pipeline'] else self.pipeline['pipeline']['name']
+    
+    def subpipeline(self, steps, location, step_index, branch=None):
+        # creates a sub-pipeline for the step at step_index (and the given branch of a parallel step),
+        # and includes its tests and docker builds in this pipeline
+        subpipeline = Pipeline(self.path, self.host_path, pipeline={ 'name': self.name, 'pipeline': steps }, start_location=location, depth=self.depth+1)
+        self.builds.extend(subpipeline.builds)
+        for test_input in subpipeline.tests:
+            if not test_input in self.tests:
+                self.tests[test_input] = {}
+            for subtest_id in subpipeline.tests[test_input]:
+                self.tests[test_input][str(step_index)+('.'+str(branch) if branch is not None else '')+'.'+subtest_id] = subpipeline.tests[test_input][subtest_id]
+        return subpipeline
+    
+    def executor(self, step):
+        # the executor, entrypoint and resources of an image or dockerfile step; the entrypoint is relative to pipeline.yml
+        executor = step.get('executor', 'docker')
+        if not Executor.get(executor):
+            Common.message("WARNING: unknown executor '"+str(executor)+"' (using docker): "+str(step['__location__']))
+            executor = 'docker'
+        if executor == 'local' and not step.get('entrypoint'):
+            Common.message("WARNING: the local executor requires an entrypoint (using docker): "+str(step['__location__']))
+            executor = 'docker'
+        entrypoint = os.path.abspath(os.path.join(os.path.dirname(self.path), step['entrypoint'])) if executor == 'local' else None
+        return { 'executor': executor, 'entrypoint': entrypoint,
+                 'cpus': float(step['cpus']) if 'cpus' in step else None,
+                 'memory': Common.parse_size(step['memory']) if 'memory' in step else None }
+    
+    def add_test(self, test_input, test):
+        if not test_input in self.tests:
+            self.tests[test_input] = {}
+        self.tests[test_input][str(len(self.steps))] = test
+        self.steps.append(test)
+
+    def run(self, config_path, input_path, output_path, status_path, status="", test=None, step_id='', context=None, prune=False, journal=None):
+        # the intermediate directories of a journaled run are kept until the whole run has finished
+        temp_path = journal.temp_path(step_id) if journal else Workspace.mkdtemp('pipeline-')
+        try:
+            return self.run_steps(temp_path, config_path, input_path, output_path, status_path, status=status, test=test, step_id=step_id, context=context, prune=prune, journal=journal)
+        finally:
+            if not journal:
+                Workspace.release(temp_path)
+    
+    def run_journaled(self, journal):
+        Common.message(_('Run ID:')+' '+journal.run_id)
+        journal.start()
+        info = journal.info
+        if not os.path.isdir(info['output']):
+            os.makedirs(info['output'])
+        Events.publish('run-started', run=journal.run_id, input=info['input'])
+        try:
+            result = self.run(info['config'], info['input'], info['output'], info['status'], journal=journal)
+        except Exception as e:
+            Events.publish('run-finished', run=journal.run_id, success=False, error=str(e))
+            raise
+        finally:
+            if StepCache.get():
+                StepCache.get().save()
+        journal.finish()
+        Events.publish('run-finished', run=journal.run_id, success=True, status=Common.first_line(info['status']))
+        Common.message(_('Status:')+' '+Common.first_line(info['status']))
+        return result
+    
+    def run_image(self, step, volumes, output_path, status_path, record):
+        # runs an image step, or restores its result from the step cache. Returns whether it succeeded.
+        # The exit code, container timings and whether the cache was used are added to the metrics record.
+        executor = Executor.get(step.executor)
+        cache = StepCache.get() if step.cache else None
+        cache_key = cache.key(executor.image_id(step), volumes, command=step.command) if cache else None
+        record['cached'] = False
+        if cache_key and cache.restore(cache_key, output_path, status_path):
+            Common.message(step.padding+'   Using cached result')
+            record['cached'] = True
+            return True
+        record['container'] = {}
+        exit_code = executor.run(step, volumes, stats=record['container'], resources=Metrics.get().detailed)
+        record['queue_seconds'] = record['container'].pop('queue', 0.0)
+        record['exit_code'] = exit_code
+        if cache_key and exit_code == 0:
+            cache.store(cache_key, output_path, status_path)
+        return exit_code == 0
+    
+    @staticmethod
+    def merge_status(status_paths, target):
+        # copies the status files of several items into target, in order, so that a file from a
+        # later item replaces the file with the same name from an earlier item
+        for status_path in status_paths:
+            if not os.path.isdir(status_path):
+                continue
+            for file in sorted(os.listdir(status_path)):
+                if os.path.isdir(target+"/"+file):
+                    shutil.rmtree(target+"/"+file)
+                elif os.path.exists(target+"/"+file):
+                    os.remove(target+"/"+file)
+                Transfer.copy(status_path+"/"+file, target+"/"+file)
+    
+    @staticmethod
+    def journals_nested_steps(step):
+        # whether the steps inside the step are recorded in the journal on their own
+        return step.type in ['choose', 'parallel'] or step.type == 'foreach' and not step.batch
+    
+    @staticmethod
+    def clear_directory(path):
+        if not os.path.isdir(path):
+            return
+        for item in os.listdir(path):
+            if os.path.isdir(path+"/"+item) and not os.path.islink(path+"/"+item):
+                shutil.rmtree(path+"/"+item)
+            else:
+                os.remove(path+"/"+item)
+    
+    @staticmethod
+    def batches(items, size):
+        # splits the items of a foreach step into batches, without repeating a name within a batch
+        batches = []
+        names = set()
+        for item in items:
+            if not batches or len(batches[-1]) >= size or os.path.basename(item) in names:
+                batches.append([])
+                names = set()
+            batches[-1].append(item)
+            names.add(os.path.basename(item))
+        return batches
+    
+    def run_batch(self, config_path, items, output_path, status_path, step_id='', run=None):
+        # runs several items of a foreach step through this pipeline, which only contains image steps,
+        # with one container per step for the whole batch. Each item gets its own subdirectory
+        # in /mnt/input, /mnt/output and /mnt/status, named after the item.
+        temp_path = Workspace.mkdtemp('batch-')
+        try:
+            names = [ os.path.basename(item) for item in items ]
+            current_input_path = temp_path+"/input"
+            for item in items:
+                os.makedirs(current_input_path+"/"+os.path.basename(item))
+                Transfer.copy(item, current_input_path+"/"+os.path.basename(item)+"/"+os.path.basename(item), link=Workspace.intermediate(item))
+            
+            for step in self.steps:
+                Common.message(step.padding+'-- Running image: '+step.name+' ('+str(len(items))+' items)')
+                step_start = time.time()
+                Events.publish('step-started', run=run, step_id=step_id+'/'+str(step.position), location=step.location, step_type=step.type, name=step.name, items=len(items))
+                current_output_path = temp_path+"/"+str(step.position)+"/output"
+                current_status_path = temp_path+"/"+str(step.position)+"/status"
+                for name in names:
+                    os.makedirs(current_output_path+"/"+name)
+                    os.makedirs(current_status_path+"/"+name)
+                volumes = {}
+                if config_path:
+                    volumes[config_path] = { 'bind': '/mnt/config', 'mode': 'ro' }
+                volumes[current_input_path] = { 'bind': '/mnt/input', 'mode': 'ro' }
+                volumes[current_output_path] = { 'bind': '/mnt/output', 'mode': 'rw' }
+                volumes[current_status_path] = { 'bind': '/mnt/status', 'mode': 'rw' }
+                record = { 'step_id': step_id+'/'+str(step.position), 'location': step.location, 'type': step.type, 'name': step.name, 'items': len(items) }
+                success = self.run_image(step, volumes, current_output_path, current_status_path, record)
+                Metrics.get().step(record, step_start, current_input_path, current_output_path, success)
+                Events.publish('step-finished', run=run, step_id=record['step_id'], location=step.location, step_type=step.type, name=step.name, items=len(items), success=success, seconds=record['seconds'])
+                Workspace.release(temp_path+"/input" if step.position == 0 else temp_path+"/"+str(step.position-1))
+                current_input_path = current_output_path
+            
+            # split the results back out as if the items had been run one by one
+            for name in names:
+                Transfer.move_contents(current_output_path+"/"+name, output_path+"/"+name)
+            for file in os.listdir(current_output_path):
+                if not file in names:
+                    Common.message(self.padding+"   WARNING: output not belonging to any item in the batch: "+file)
+            
+            # the statuses of the items are merged like when they are run one by one.
+            # A status written for the whole batch is applied after the statuses of the items.
+            for name in names:
+                os.rename(current_status_path+"/"+name, temp_path+"/status-"+name)
+            Pipeline.merge_status([ temp_path+"/status-"+name for name in names ] + [ current_status_path ], status_path)
+        finally:
+            Workspace.release(temp_path)
+    
+    def run_steps(self, temp_path, config_path, input_path, output_path, status_path, status="", test=None, step_id='', context=None, prune=False, journal=None):
         tests_run = 0
         tests_failed = 0
         tests_skipped = 0
         
-        pipeline_context_name = os.path.basename(input_path)
-        padding = (self.location if len(self.steps) == 0 else self.steps[0][list(self.steps[0].keys())[0]]['location']).ljust(20+step_depth*2)
-        Common.message(padding+'-- Context is: '+pipeline_context_name)
+        pipeline_context_name = context if context else os.path.basename(input_path)
+        run = journal.run_id if journal else test  # identifies the run in progress events
+        Common.message(self.padding+'-- Context is: '+pipeline_context_name)
         
         current_input_path = None
         current_output_path = None
@@ -193,8 +310,7 @@ class Pipeline:
         current_status = ''
         
         exit = False
-        position = 0
-        step_count = len([ step_object for step_object in self.steps if (list(step_object.keys())[0] != 'test' and list(step_object.keys())[0] != 'assert') ])
+        step_count = self.step_count
         if step_count == 0:
             current_status = status
             current_input_path = input_path
@@ -202,82 +318,147 @@ class Pipeline:
             current_status_path = status_path
             if status != None:
                 Common.write_file(current_status_path+'/status.txt', status)
-            if os.path.isdir(current_input_path):
-                for item in os.listdir(current_input_path):
-                    item_fullpath = os.path.join(current_input_path, item)
-                    if os.path.isdir(item_fullpath):
-                        shutil.copytree(item_fullpath, current_output_path+'/'+os.path.basename(item_fullpath))
-                    else:
-                        shutil.copy2(item_fullpath, current_output_path+'/'+os.path.basename(item_fullpath))
-            else:
-                shutil.copy2(current_input_path, current_output_path+'/'+os.path.basename(current_input_path))
+            # files are only hardlinked from intermediate results, and not from the input of the run
+            Transfer.copy_contents(current_input_path, current_output_path, link=Workspace.intermediate(current_input_path))
             
-        for step_object in self.steps:
-            step_type = list(step_object.keys())[0]
-            step = step_object[step_type]
-            padding = step['location'].ljust(20+step_depth*2)
+        # when pruning, steps after the last one with tests for the current test input are skipped
+        last_step = self.last_test_step(test, pipeline_context_name) if prune and test and test != '*' else len(self.steps)
+        
+        for step_index, step in enumerate(self.steps):
+            padding = step.padding
             
-            if exit or step_type == 'exit':
-                if step_type == 'exit':
+            if step_index > last_step:
+                Common.message(padding+'-- Skipping the remaining steps, there are no more tests for: '+test)
+                break
+            
+            if exit or step.type == 'exit':
+                if step.type == 'exit':
                     Common.message(padding+'-- Exiting')
                 exit = True
                 break
             
             current_status = status if not current_status_path else Common.first_line(current_status_path)
             
-            if step_type != 'test' and step_type != 'assert':
+            if step.type != 'test':
+                if journal:
+                    journal.check_cancelled()
+                position = step.position
                 current_step_id = step_id+'/'+str(position)
-                Common.message(padding+'-- Running '+step_type+': '+(step_type if not 'name' in step else step['name']))
+                Common.message(padding+'-- Running '+step.type+': '+getattr(step, 'name', step.type))
+                Events.publish('step-started', run=run, step_id=current_step_id, location=step.location, step_type=step.type, name=getattr(step, 'name', step.type), context=pipeline_context_name)
                 
                 if position > 0:
                     current_input_path = current_output_path
                 else:
                     current_input_path = input_path
                 
+                completed = journal.completed_step(current_step_id, current_input_path) if journal else None
+                
+                if not completed and journal and journal.resumed() and not Pipeline.journals_nested_steps(step):
+                    # partial results from an earlier attempt of this run. The results of steps that contain
+                    # journaled steps (such as the finished items of a foreach) are kept, as those are skipped.
+                    shutil.rmtree(temp_path+"/"+str(position), ignore_errors=True)
+                    if position == step_count - 1:
+                        Pipeline.clear_directory(output_path)
+                        Pipeline.clear_directory(status_path)
+                
                 if position < step_count - 1:
                     current_output_path = temp_path+"/"+str(position)+"/output"
                     current_status_path = temp_path+"/"+str(position)+"/status"
-                    os.makedirs(current_output_path)
-                    os.makedirs(current_status_path)
+                    if not completed:
+                        for path in [ current_output_path, current_status_path ]:
+                            if not os.path.isdir(path):
+                                os.makedirs(path)
                 else:
                     current_output_path = output_path
                     current_status_path = status_path
                 
-                if step_type == 'image':
+                if completed:
+                    Common.message(padding+'   Already completed in an earlier attempt of this run')
+                    Events.publish('step-finished', run=run, step_id=current_step_id, location=step.location, step_type=step.type, name=getattr(step, 'name', step.type), context=pipeline_context_name, success=True, seconds=0.0, skipped=True)
+                    exit = exit or completed['exit']
+                    continue
+                
+                success = True
+                step_start = time.time()
+                record = { 'step_id': current_step_id, 'location': step.location, 'type': step.type, 'name': getattr(step, 'name', step.type), 'context': pipeline_context_name }
+                
+                if step.type == 'image':
                     volumes = {}
                     if config_path:
                         volumes[config_path] = { 'bind': '/mnt/config', 'mode': 'ro' }
                     volumes[current_input_path] = { 'bind': '/mnt/input'+('/'+pipeline_context_name if not os.path.isdir(current_input_path) else ''), 'mode': 'ro' }
                     volumes[current_output_path] = { 'bind': '/mnt/output', 'mode': 'rw' }
                     volumes[current_status_path] = { 'bind': '/mnt/status', 'mode': 'rw' }
-                    
-                    command = None if not 'command' in step else step['command']
-                    
-                    Common.docker_run(step['id'], volumes, command=command)
+                    success = self.run_image(step, volumes, current_output_path, current_status_path, record)
                 
-                elif step_type == 'choose':
-                    for when in step['choices']:
-                        when_key = list(when.keys())[0]
-                        if (not 'test' in when[when_key]) or when[when_key]['test'] == current_status:
-                            result = when[when_key]['pipeline'].run(config_path, file_or_dir, current_output_path, current_status_path, status=current_status, test=test, step_id=current_step_id, step_depth=step_depth+1)
+                elif step.type == 'choose':
+                    for choice in step.choices:
+                        if choice.test is None or choice.test == current_status:
+                            result = choice.pipeline.run(config_path, current_input_path, current_output_path, current_status_path, status=current_status, test=test, step_id=current_step_id, context=pipeline_context_name, prune=(step_index == last_step), journal=journal)
                             exit = exit or result['exit']
                             tests_skipped += result['tests']['skipped']
                             tests_run += result['tests']['run']
                             tests_failed += result['tests']['failed']
                             break
                 
-                elif step_type == 'foreach':
-                    for file_or_dir in Common.list_files(current_input_path):
-                        result = step['pipeline'].run(config_path, file_or_dir, current_output_path+'/'+os.path.basename(file_or_dir), current_status_path, status=current_status, test=test, step_id=current_step_id, step_depth=step_depth+1)
+                elif step.type == 'foreach':
+                    workers = step.workers if step.workers is not None else int(Common.get_config("foreach-workers", 1))
+                    items = Common.list_files(current_input_path)
+                    items_finished = itertools.count(1)
+                    # each item (or batch) has its own status directory, so that concurrent items can't overwrite
+                    # each other's status. They are merged in the order of the items when all of them are done.
+                    items_status_path = temp_path+"/"+str(position)+"/items"
+                    if step.batch:
+                        batches = Pipeline.batches(items, step.batch)
+                        item_status_paths = [ items_status_path+"/"+str(batch_index) for batch_index in range(len(batches)) ]
+                        def run_batch(batch_index):
+                            batch = batches[batch_index]
+                            item_start = time.time()
+                            os.makedirs(item_status_paths[batch_index])
+                            step.pipeline.run_batch(config_path, batch, current_output_path, item_status_paths[batch_index], step_id=current_step_id, run=run)
+                            Metrics.get().item(step.location, current_step_id, [ os.path.basename(item) for item in batch ], item_start, items=len(batch))
+                            for item in batch:
+                                Events.publish('item-finished', run=run, step_id=current_step_id, location=step.location, item=os.path.basename(item), finished=next(items_finished), items=len(items))
+                        for result in Common.run_parallel(run_batch, range(len(batches)), workers):
+                            pass
+                    else:
+                        item_status_paths = [ items_status_path+"/"+os.path.basename(item) for item in items ]
+                        def run_item(file_or_dir):
+                            item_start = time.time()
+                            item_status_path = items_status_path+"/"+os.path.basename(file_or_dir)
+                            if not os.path.isdir(item_status_path):
+                                os.makedirs(item_status_path)
+                            result = step.pipeline.run(config_path, file_or_dir, current_output_path+'/'+os.path.basename(file_or_dir), item_status_path, status=current_status, test=test, step_id=current_step_id+'/'+os.path.basename(file_or_dir), prune=(step_index == last_step), journal=journal)
+                            Metrics.get().item(step.location, current_step_id, os.path.basename(file_or_dir), item_start)
+                            Events.publish('item-finished', run=run, step_id=current_step_id, location=step.location, item=os.path.basename(file_or_dir), finished=next(items_finished), items=len(items))
+                            return result
+                        for result in Common.run_parallel(run_item, items, workers):
+                            exit = exit or result['exit']
+                            tests_skipped += result['tests']['skipped']
+                            tests_run += result['tests']['run']
+                            tests_failed += result['tests']['failed']
+                    Pipeline.merge_status(item_status_paths, current_status_path)
+
+                elif step.type == 'parallel':
+                    # all branches read the same input, and write to their own subdirectory of the output and status
+                    workers = step.workers if step.workers is not None else len(step.branches)
+                    def run_branch(branch):
+                        for path in [ current_output_path+'/'+branch.name, current_status_path+'/'+branch.name ]:
+                            if not os.path.isdir(path):
+                                os.makedirs(path)
+                        return branch.pipeline.run(config_path, current_input_path, current_output_path+'/'+branch.name, current_status_path+'/'+branch.name, status=current_status, test=test, step_id=current_step_id+'/'+branch.name, context=pipeline_context_name, prune=(step_index == last_step), journal=journal)
+                    for result in Common.run_parallel(run_branch, step.branches, workers):
                         exit = exit or result['exit']
                         tests_skipped += result['tests']['skipped']
                         tests_run += result['tests']['run']
                         tests_failed += result['tests']['failed']
-                
-                elif step_type == 'unfold':
+                    Common.write_file(current_status_path+'/status.txt', ParallelStep.combined_status([ Common.first_line(current_status_path+'/'+branch.name) for branch in step.branches ]))
+
+                elif step.type == 'unfold':
                     prev_paths = []
                     paths = [ current_input_path ]
-                    depth = step['depth']
+                    depth = step.depth
                     while depth >= 0:
                         depth -= 1
                         prev_paths = list(paths)
@@ -287,72 +468,69 @@ class Pipeline:
                                 continue
                             for item in os.listdir(current_path):
                                 paths.append(os.path.join(current_path, item))
+                    unfold_start = time.time()
                     for path in paths:
                         if os.path.exists(current_output_path+'/'+os.path.basename(path)):
                             Common.message(padding+"   WARNING: file naming collision when unfolding: "+os.path.basename(path))
                             continue
-                        if os.path.isdir(path):
-                            shutil.copytree(path, current_output_path+'/'+os.path.basename(path))
+                        if current_input_path.startswith(temp_path+'/') and not journal:
+                            # the output from the previous step in this pipeline won't be used again
+                            Transfer.move(path, current_output_path+'/'+os.path.basename(path))
                         else:
-                            shutil.copy2(path, current_output_path+'/'+os.path.basename(path))
+                            Transfer.copy(path, current_output_path+'/'+os.path.basename(path), link=Workspace.intermediate(path))
+                    Common.add_timing('transfer', time.time() - unfold_start)
 
                 else:
-                    Common.message(padding+"   ERROR: could not process step type: "+step_type)
+                    Common.message(padding+"   ERROR: could not process step type: "+step.type)
                     current_output_path = current_input_path
                 
-                position += 1
+                Metrics.get().step(record, step_start, current_input_path, current_output_path, success)
+                Events.publish('step-finished', run=run, step_id=current_step_id, location=step.location, step_type=step.type, name=record['name'], context=pipeline_context_name, success=success, seconds=record['seconds'])
+                
+                if journal and success:
+                    journal.complete(current_step_id, current_input_path, current_output_path, current_status_path, exit=exit)
+                
+                if position > 0 and not journal and not current_output_path.startswith(temp_path+"/"+str(position-1)+"/"):
+                    # the output of the previous step has been consumed by this step
+                    Workspace.release(temp_path+"/"+str(position-1))
             
             else:
-                if step['name'] == test or test == '*' or step['name'] == '*':
-                    if 'context' in step and not step['context'] == pipeline_context_name:
+                if step.name == test or test == '*' or step.name == '*':
+                    if step.context is not None and not step.context == pipeline_context_name:
                         continue
                     
                     success = True
                     
-                    Common.message(padding+'-- Evaluating test: '+step['name'])
-                    if 'expect' in step:
+                    Common.message(padding+'-- Evaluating test: '+step.name)
+                    if step.expect is not None:
                         tests_run += 1
-                        expected_files = {}
-                        actual_files = {}
                         actual_path = current_output_path if current_output_path else input_path
-                        expected_path = os.path.dirname(self.path)+"/tests/"+step['expect']
+                        expected_path = os.path.dirname(self.path)+"/tests/"+step.expect
+                        actual_files = HashIndex.list_files(actual_path)
+                        expected_files = HashIndex.list_files(expected_path)
                         
-                        if os.path.isdir(actual_path):
-                            for root, subdirs, files in os.walk(actual_path):
-                                for file in files:
-                                    actual_files[os.path.relpath(root, actual_path)+'/'+file] = {'hash': Common.hashfile(root+'/'+file),
-                                                                                                 'fullpath': root+'/'+file }
-                        else:
-                            actual_files['./'+os.path.basename(actual_path)] = {'hash': Common.hashfile(actual_path),
-                                                                                'fullpath': actual_path }
-                        if os.path.isdir(expected_path):
-                            for root, subdirs, files in os.walk(expected_path):
-                                for file in files:
-                                    expected_files[os.path.relpath(root, expected_path)+'/'+file] = {'hash': Common.hashfile(root+'/'+file),
-                                                                                                     'fullpath': root+'/'+file }
-                        else:
-                            expected_files['./'+os.path.basename(expected_path)] = {'hash': Common.hashfile(expected_path),
-                                                                                    'fullpath': expected_path }
+                        # only files that are present in both and have the same size need to be hashed.
+                        # The expected files are hashed through the index as they rarely change.
+                        same_size = set([ file for file in actual_files if file in expected_files and actual_files[file]['size'] == expected_files[file]['size'] ])
+                        hashes = HashIndex.get().hashfiles([ actual_files[file]['fullpath'] for file in same_size ],
+                                                           indexed_paths=[ expected_files[file]['fullpath'] for file in same_size ])
                         
                         for file in actual_files:
                             if not file in expected_files:
                                 Common.message(padding+"   FAILED: file should not be present in output: "+file)
                                 success = False
-                            elif expected_files[file]['hash'] != actual_files[file]['hash']:
+                            elif not file in same_size or hashes[expected_files[file]['fullpath']] != hashes[actual_files[file]['fullpath']]:
                                 Common.message(padding+"   FAILED: content in actual and expected files differ: "+file)
                                 success = False
-                                mime = mimetypes.guess_type(file)
-                                if mime[0].startswith('text/') and os.stat(actual_files[file]['fullpath']).st_size < 1000000 and os.stat(expected_files[file]['fullpath']).st_size < 1000000:
-                                    with open(expected_files[file]['fullpath'], 'r') as expected_file:
-                                        with open(actual_files[file]['fullpath'], 'r') as actual_file:
-                                            expected_lines = expected_file.readlines()
-                                            actual_lines = actual_file.readlines()
-                                            max_lines = 30
-                                            for diffline in difflib.unified_diff(expected_lines, actual_lines, fromfile=file, tofile=file):
-                                                Common.message(padding+diffline.strip())
-                                                max_lines -= 1
-                                                if max_lines <= 0:
-                                                    break
+                                if Diff.is_text(expected_files[file]['fullpath']) and Diff.is_text(actual_files[file]['fullpath']):
+                                    max_lines = int(Common.get_config("diff-max-lines", 30))
+                                    for diffline in Diff.unified_diff(expected_files[file]['fullpath'], actual_files[file]['fullpath'], fromfile=file, tofile=file,
+                                                                      context_lines=int(Common.get_config("diff-context-lines", 3)),
+                                                                      window_lines=int(Common.get_config("diff-window-lines", 200))):
+                                        Common.message(padding+diffline)
+                                        max_lines -= 1
+                                        if max_lines <= 0:
+                                            break
                         for file in expected_files:
                             if not file in actual_files:
                                 Common.message(padding+"   FAILED: file should be present in output: "+file)
@@ -371,14 +549,15 @@ class Pipeline:
                             Common.message(padding+"   ACTUAL:   "+actual_compact)
                             Common.message(padding+"   EXPECTED: "+expected_compact)
                     
-                    if 'status' in step:
-                        expected_status = '' if step['status'] == None else str(step['status'])
+                    if step.status is not None:
+                        expected_status = str(step.status)
                         if current_status != expected_status:
                             Common.message(padding+"   FAILED: actual status and expected status differ:")
                             Common.message(padding+"     expected: "+expected_status)
                             Common.message(padding+"       actual: "+current_status)
                             success = False
                     
+                    Events.publish('test-finished', run=run, location=step.location, name=step.name, context=pipeline_context_name, success=success)
                     if not success:
                         tests_failed += 1
                     tests_run += 1
@@ -392,11 +571,11 @@ class Pipeline:
             }
         }
     
-    def run_tests(self):
+    def run_tests(self, jobs=1):
         focus = None
         for test_name in self.tests:
             for test_id in self.tests[test_name]:
-                if 'focus' in self.tests[test_name][test_id]:
+                if self.tests[test_name][test_id].focus is not None:
                     focus = test_name
                     Common.message(_('Focusing on test:')+' '+test_name)
                     break
@@ -405,61 +584,65 @@ class Pipeline:
         tests_failed = 0
         tests_skipped = 0
         
-        for test_name in self.tests:
-            if test_name == '*':
-                continue
-            if focus and test_name != focus:
-                continue
-            Common.message("\n---\n"+_('Running test:')+' '+test_name+"\n")
-            
-            test = self.tests[test_name]
-            
-            temp_path = tempfile.mkdtemp(prefix='test-')
-            tests_path = os.path.dirname(self.path)+"/tests"
-            
-            config_path = None # tests_path+"/"+test_name+"/config"
-            input_path = tests_path+"/"+test_name
-            output_path = temp_path+"/"+test_name+"/output"
-            status_path = temp_path+"/"+test_name+"/status"
-            os.makedirs(output_path)
-            os.makedirs(status_path)
-            
-            result = self.run(config_path, input_path, output_path, status_path, test=test_name)
+        test_names = [ test_name for test_name in self.tests if test_name != '*' and (not focus or test_name == focus) ]
+        for result in Common.run_parallel(self.run_test, test_names, jobs):
             tests_run += result['tests']['run']
             tests_failed += result['tests']['failed']
             tests_skipped += result['tests']['skipped']
-            
-            Common.message("")
-            Common.message(_('Host system path to pipeline output is:')+' '+Common.host_path(os.path.dirname(output_path)))
         
         Common.message("")
         if focus:
-            Common.message(_('Test in focus:')+' '+test_name)
+            Common.message(_('Test in focus:')+' '+focus)
         Common.message("TESTS RUN: "+str(tests_run))
         Common.message("TESTS FAILED: "+str(tests_failed))
+        docker_api_stats = Common.docker_api_stats()
+        Common.message("DOCKER API CALLS: "+', '.join([method+': '+str(docker_api_stats[method]['calls'])+' ('+'%.2f' % docker_api_stats[method]['seconds']+'s)' for method in sorted(docker_api_stats)]))
+        transfer_stats = Transfer.stats()
+        Common.message("BYTES TRANSFERRED: "+', '.join([method+': '+str(transfer_stats[method]) for method in ['renamed', 'hardlinked', 'reflinked', 'copied']]))
+        if StepCache.get():
+            StepCache.get().save()
+            Common.message("CACHE HITS: "+str(StepCache.get().hits))
+            Common.message("CACHE MISSES: "+str(StepCache.get().misses))
         #Common.message("TESTS SKIPPED: "+str(tests_skipped))
     
-    def get_serializable(self, tests=False):
-        steps = self.steps
-        if not tests:
-            steps = [ step for step in self.steps if (list(step.keys())[0] != 'test' and list(step.keys())[0] != 'assert')]
-        return self.__get_serializable(steps, tests=False)
+    def run_test(self, test_name):
+        Common.message("\n---\n"+_('Running test:')+' '+test_name+"\n")
+        
+        temp_path = Workspace.mkdtemp('test-')
+        tests_path = os.path.dirname(self.path)+"/tests"
+        
+        config_path = None # tests_path+"/"+test_name+"/config"
+        input_path = tests_path+"/"+test_name
+        output_path = temp_path+"/"+test_name+"/output"
+        status_path = temp_path+"/"+test_name+"/status"
+        os.makedirs(output_path)
+        os.makedirs(status_path)
+        
+        Events.publish('run-started', run=test_name, input=input_path)
+        result = self.run(config_path, input_path, output_path, status_path, test=test_name, prune=Common.get_config("prune-tests", True))
+        Events.publish('run-finished', run=test_name, success=result['tests']['failed'] == 0, tests=result['tests'])
+        
+        if Workspace.finish(temp_path, failed=result['tests']['failed'] > 0):
+            # the path is the same on the host when work-dir is not mounted from it (for instance outside docker)
+            Common.message("")
+            Common.message(_('Host system path to pipeline output is:')+' '+(Common.host_path(os.path.dirname(output_path)) or os.path.dirname(output_path)))
+        
+        return result
     
-    def __get_serializable(self, obj, tests=False):
-        if isinstance(obj, list):
-            serializable_list = []
-            for item in obj:
-                serializable_list.append(self.__get_serializable(item, tests=False))
-            return serializable_list
-            
-        elif isinstance(obj, dict):
-            serializable_dict = {}
-            for key in obj:
-                serializable_dict[key] = self.__get_serializable(obj[key], tests=False)
-            return serializable_dict
-            
-        elif isinstance(obj, Pipeline):
-            return obj.get_serializable(tests=False)
-            
-        else:
-            return obj
+    def last_test_step(self, test, context):
+        # the index in self.steps of the last step containing tests for the given test input, or -1.
+        # Tests directly in this pipeline for another context are ignored; for tests in
+        # sub-pipelines the context is not known until they are run.
+        if not (test, context) in self.last_test_steps:
+            last_step = -1
+            for test_input in [test, '*']:
+                for test_id in self.tests.get(test_input, {}):
+                    test_step = self.tests[test_input][test_id]
+                    if not '.' in test_id and test_step.context is not None and test_step.context != context:
+                        continue
+                    last_step = max(last_step, int(test_id.split('.')[0]))
+            self.last_test_steps[(test, context)] = last_step
+        return self.last_test_steps[(test, context)]
+    
+    def get_serializable(self, tests=False):
+        return [ step.serializable() for step in self.steps if tests or step.type != 'test' ]
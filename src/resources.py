@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import threading
+import itertools
+from common import Common
+
+global resources
+resources = None
+resources_lock = threading.Lock()
+
+class Resources:
+
+    # Admits containers while the CPUs and memory declared by their steps (`cpus` and `memory`
+    # in pipeline.yml) fit within the budget of the machine they run on. Resources.get() is the
+    # budget of this machine, host-cpus (default: the number of CPUs) and host-memory (default:
+    # no limit) from config.yml; each of the docker-hosts has its own (see DockerHost).
+    # Steps are admitted in the order they ask, so that a large step is not starved by smaller
+    # ones. A step that is larger than the whole budget is run when nothing else is running.
+    # Steps that declare nothing are never held back.
+
+    def __init__(self, cpus, memory=None):
+        self.cpus = cpus
+        self.memory = memory
+        self.used_cpus = 0.0
+        self.used_memory = 0
+        self.running = 0
+        self.condition = threading.Condition()
+        self.tickets = itertools.count()
+        self.waiting = []  # tickets of the steps that are waiting, in order
+
+    @staticmethod
+    def get():
+        global resources
+        with resources_lock:
+            if resources is None:
+                memory = Common.get_config("host-memory", None)
+                resources = Resources(float(Common.get_config("host-cpus", os.cpu_count() or 1)), Common.parse_size(memory) if memory else None)
+        return resources
+
+    def fits(self, cpus, memory):
+        if self.running == 0:
+            return True
+        if self.used_cpus + cpus > self.cpus:
+            return False
+        return self.memory is None or self.used_memory + memory <= self.memory
+
+    def acquire(self, cpus, memory):
+        # waits until the step can run; returns the number of seconds spent waiting
+        if not cpus and not memory:
+            return 0.0
+        start_time = time.time()
+        with self.condition:
+            ticket = next(self.tickets)
+            self.waiting.append(ticket)
+            while self.waiting[0] != ticket or not self.fits(cpus, memory):
+                self.condition.wait()
+            self.waiting.pop(0)
+            self.used_cpus += cpus
+            self.used_memory += memory
+            self.running += 1
+            self.condition.notify_all()
+        return time.time() - start_time
+
+    def run(self, step, stats, function):
+        # calls function when the step fits, and adds the time spent waiting to stats as 'queue'
+        cpus, memory = step.cpus or 0.0, step.memory or 0
+        seconds = self.acquire(cpus, memory)
+        if stats is not None:
+            stats['queue'] = stats.get('queue', 0.0) + seconds
+        if seconds >= 1:
+            Common.message(step.padding+'   Waited '+str(int(seconds))+' seconds for CPUs and memory')
+        try:
+            return function()
+        finally:
+            self.release(cpus, memory)
+
+    def release(self, cpus, memory):
+        if not cpus and not memory:
+            return
+        with self.condition:
+            self.used_cpus -= cpus
+            self.used_memory -= memory
+            self.running -= 1
+            self.condition.notify_all()
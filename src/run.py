@@ -10,7 +10,9 @@ import gettext
 
 from pipeline import Pipeline
 from common import Common
+from journal import Journal
 from web import Web
+from watch import Watch
 
 global _
 
@@ -21,7 +23,32 @@ def main(argv):
     pipeline = Pipeline(path="/mnt/pipeline/pipeline.yml", host_path=argv[0])
     
     if len(argv) > 2 and argv[2] == "test":
-        pipeline.run_tests()
+        jobs = "1"
+        for index, arg in enumerate(argv[3:], 3):
+            if arg == "--jobs":
+                jobs = argv[index + 1] if index + 1 < len(argv) else ""
+            elif arg.startswith("--jobs="):
+                jobs = arg[len("--jobs="):]
+        if not jobs.isdigit() or int(jobs) < 1:
+            Common.message(_('--jobs must be a positive number')+": "+jobs)
+        else:
+            pipeline.run_tests(jobs=int(jobs))
+        
+    elif len(argv) > 4 and argv[2] == "run":
+        journal = Journal.create(argv[3], argv[4], config_path="/mnt/config" if os.path.isdir("/mnt/config") else None)
+        pipeline.run_journaled(journal)
+        
+    elif len(argv) > 3 and argv[2] == "resume":
+        journal = Journal.open(argv[3])
+        if not journal:
+            Common.message(_('Unknown run ID')+": "+argv[3])
+        elif journal.info['finished']:
+            Common.message(_('The run has already finished')+": "+argv[3])
+        else:
+            pipeline.run_journaled(journal)
+        
+    elif len(argv) > 4 and argv[2] == "watch":
+        Watch(pipeline, argv[3], argv[4]).run()
         
     elif len(argv) > 2 and argv[2]:
         Common.message(_('Unknown argument')+": "+argv[2])
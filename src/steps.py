@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+class Step:
+
+    # A compiled pipeline step. Steps are created once when the pipeline is loaded,
+    # and everything that doesn't depend on the input is computed up front.
+    # The serializable form is the same as the one used by the web view.
+
+    __slots__ = ('location', 'padding', 'position')
+    type = None
+
+    def __init__(self, location, depth):
+        self.location = location
+        self.padding = location.ljust(20+depth*2)
+        self.position = None  # index among the steps that are not tests; set by the pipeline
+
+    def serializable(self):
+        return { self.type: self.fields() }
+
+    def fields(self):
+        return { 'location': self.location }
+
+class ExitStep(Step):
+
+    __slots__ = ()
+    type = 'exit'
+
+class ImageStep(Step):
+
+    __slots__ = ('name', 'id', 'build_path', 'command', 'cache', 'executor', 'entrypoint', 'cpus', 'memory')
+    type = 'image'
+
+    def __init__(self, location, depth, name, id, build_path=None, command=None, cache=True, executor='docker', entrypoint=None, cpus=None, memory=None):
+        Step.__init__(self, location, depth)
+        self.name = name
+        self.id = id
+        self.build_path = build_path  # the directory with the Dockerfile, for dockerfile steps
+        self.command = command
+        self.cache = cache
+        self.executor = executor
+        self.entrypoint = entrypoint  # path to the script or program run by the local executor
+        self.cpus = cpus
+        self.memory = memory  # bytes
+
+    def fields(self):
+        fields = { 'location': self.location, 'name': self.name, 'id': self.id }
+        if self.command is not None:
+            fields['command'] = self.command
+        if self.executor != 'docker':
+            fields['executor'] = self.executor
+            fields['entrypoint'] = self.entrypoint
+        if self.cpus is not None:
+            fields['cpus'] = self.cpus
+        if self.memory is not None:
+            fields['memory'] = self.memory
+        return fields
+
+class UnfoldStep(Step):
+
+    __slots__ = ('depth',)
+    type = 'unfold'
+    name = 'unfold'
+
+    def __init__(self, location, depth, unfold_depth):
+        Step.__init__(self, location, depth)
+        self.depth = unfold_depth
+
+    def fields(self):
+        return { 'location': self.location, 'name': self.name, 'depth': self.depth }
+
+class TestStep(Step):
+
+    __slots__ = ('name', 'input', 'expect', 'status', 'focus', 'context')
+    type = 'test'
+    keys = ['input', 'expect', 'status', 'focus', 'context']
+
+    def __init__(self, location, depth, name, input=None, expect=None, status=None, focus=None, context=None):
+        Step.__init__(self, location, depth)
+        self.name = name
+        self.input = input
+        self.expect = expect
+        self.status = status
+        self.focus = focus
+        self.context = context
+
+    def fields(self):
+        fields = { 'location': self.location, 'name': self.name }
+        for key in TestStep.keys:
+            if getattr(self, key) is not None:
+                fields[key] = getattr(self, key)
+        return fields
+
+class Choice:
+
+    # a sub-pipeline in a choose step; test is None for the "otherwise" choice
+
+    __slots__ = ('location', 'test', 'pipeline')
+
+    def __init__(self, location, test, pipeline):
+        self.location = location
+        self.test = test
+        self.pipeline = pipeline
+
+    def serializable(self):
+        if self.test is None:
+            return { 'otherwise': { 'location': self.location, 'pipeline': self.pipeline.get_serializable(tests=False) } }
+        return { 'when': { 'location': self.location, 'test': self.test, 'pipeline': self.pipeline.get_serializable(tests=False) } }
+
+class ChooseStep(Step):
+
+    __slots__ = ('choices',)
+    type = 'choose'
+    name = 'choose'
+
+    def __init__(self, location, depth, choices):
+        Step.__init__(self, location, depth)
+        self.choices = choices
+
+    def fields(self):
+        return { 'location': self.location, 'choices': [choice.serializable() for choice in self.choices] }
+
+class ForeachStep(Step):
+
+    __slots__ = ('name', 'pipeline', 'workers', 'batch')
+    type = 'foreach'
+
+    def __init__(self, location, depth, name, pipeline, workers=None, batch=None):
+        Step.__init__(self, location, depth)
+        self.name = name
+        self.pipeline = pipeline
+        self.workers = workers
+        self.batch = batch
+
+    def fields(self):
+        fields = { 'location': self.location, 'name': self.name, 'pipeline': self.pipeline.get_serializable(tests=False) }
+        if self.workers is not None:
+            fields['workers'] = self.workers
+        if self.batch is not None:
+            fields['batch'] = self.batch
+        return fields
+
+class Branch:
+
+    # a named sub-pipeline in a parallel step
+
+    __slots__ = ('location', 'name', 'pipeline')
+
+    def __init__(self, location, name, pipeline):
+        self.location = location
+        self.name = name
+        self.pipeline = pipeline
+
+    def serializable(self):
+        return { 'location': self.location, 'name': self.name, 'pipeline': self.pipeline.get_serializable(tests=False) }
+
+class ParallelStep(Step):
+
+    __slots__ = ('branches', 'workers')
+    type = 'parallel'
+    name = 'parallel'
+
+    def __init__(self, location, depth, branches, workers=None):
+        Step.__init__(self, location, depth)
+        self.branches = branches
+        self.workers = workers
+
+    def fields(self):
+        fields = { 'location': self.location, 'branches': [branch.serializable() for branch in self.branches] }
+        if self.workers is not None:
+            fields['workers'] = self.workers
+        return fields
+
+    @staticmethod
+    def combined_status(statuses):
+        # the status of the parallel step, given the statuses of the branches in order: the status of
+        # all branches if they agree, otherwise the first one that is neither empty nor "success"
+        if len(set(statuses)) == 1:
+            return statuses[0]
+        for status in statuses:
+            if status and status != 'success':
+                return status
+        return 'success'
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import errno
+import fcntl
+import shutil
+import itertools
+import threading
+from common import Common
+
+FICLONE = 0x40049409
+
+global transfer_stats
+transfer_stats = { 'renamed': 0, 'hardlinked': 0, 'reflinked': 0, 'copied': 0 }
+transfer_stats_lock = threading.Lock()
+unsupported = {}  # (source device, target device) => set of methods that failed between them
+temp_names = itertools.count()
+
+class Transfer:
+
+    # Moves and copies files between step directories while avoiding copying the actual bytes
+    # wherever the file system allows it. The methods are tried in this order:
+    # rename (only when moving), hardlink, reflink, and finally a regular copy.
+    # A hardlinked copy shares its contents with the source, so copies that are made from
+    # files the pipeline doesn't own (the input, the step cache), or that the user may
+    # modify, are made with link=False. Existing target files are replaced.
+
+    @staticmethod
+    def copy_contents(source, target, link=True):
+        # copies the contents of the source directory into the target directory, or the source
+        # file into the target directory if source is a file. The source is left unchanged.
+        start_time = time.time()
+        if not os.path.isdir(target):
+            os.makedirs(target)
+        if os.path.isdir(source):
+            for item in os.listdir(source):
+                Transfer.copy(os.path.join(source, item), os.path.join(target, item), link=link)
+        else:
+            Transfer.copy(source, os.path.join(target, os.path.basename(source)), link=link)
+        Common.add_timing('transfer', time.time() - start_time)
+
+    @staticmethod
+    def move_contents(source, target):
+        # like copy_contents, but source may be consumed
+        start_time = time.time()
+        if not os.path.isdir(target):
+            os.makedirs(target)
+        if os.path.isdir(source):
+            for item in os.listdir(source):
+                Transfer.move(os.path.join(source, item), os.path.join(target, item))
+        else:
+            Transfer.move(source, os.path.join(target, os.path.basename(source)))
+        Common.add_timing('transfer', time.time() - start_time)
+
+    @staticmethod
+    def move(source, target):
+        if Transfer.supported('rename', source, target):
+            try:
+                size = Common.tree_size(source)
+                os.rename(source, target)
+                Transfer.count('renamed', size)
+                return
+            except OSError as e:
+                Transfer.unsupported('rename', source, target, e)
+        Transfer.copy(source, target)
+        if os.path.isdir(source):
+            shutil.rmtree(source)
+        else:
+            os.remove(source)
+
+    @staticmethod
+    def copy(source, target, link=True):
+        if os.path.isdir(source):
+            if not os.path.isdir(target):
+                os.makedirs(target)
+            for item in os.listdir(source):
+                Transfer.copy(os.path.join(source, item), os.path.join(target, item), link=link)
+            shutil.copystat(source, target)
+            return
+
+        if os.path.lexists(target):
+            # copy to a new file and rename it over the target, so that the file the target
+            # is pointing to (which may be hardlinked from somewhere else) is left unchanged
+            temp_target = os.path.join(os.path.dirname(target), '.transfer-'+str(os.getpid())+'-'+str(next(temp_names))+'-'+os.path.basename(target))
+            try:
+                Transfer.copy(source, temp_target, link=link)
+                os.replace(temp_target, target)
+            finally:
+                if os.path.lexists(temp_target):
+                    os.remove(temp_target)
+            return
+
+        size = os.path.getsize(source)
+
+        if link and Transfer.supported('hardlink', source, target):
+            try:
+                os.link(source, target)
+                Transfer.count('hardlinked', size)
+                return
+            except OSError as e:
+                Transfer.unsupported('hardlink', source, target, e)
+
+        if Transfer.supported('reflink', source, target):
+            try:
+                with open(source, 'rb') as source_file:
+                    with open(target, 'wb') as target_file:
+                        fcntl.ioctl(target_file.fileno(), FICLONE, source_file.fileno())
+                shutil.copystat(source, target)
+                Transfer.count('reflinked', size)
+                return
+            except (IOError, OSError) as e:
+                if os.path.exists(target):
+                    os.remove(target)
+                Transfer.unsupported('reflink', source, target, e)
+
+        shutil.copy2(source, target)
+        Transfer.count('copied', size)
+
+    @staticmethod
+    def supported(method, source, target):
+        if not method in Common.get_config("transfer-methods", ['rename', 'hardlink', 'reflink']):
+            return False
+        return not method in unsupported.get(Transfer.devices(source, target), ())
+
+    @staticmethod
+    def unsupported(method, source, target, error):
+        # errors that are caused by the file system, rather than by this particular file,
+        # disables the method for all transfers between the two file systems
+        if error.errno in (errno.EXDEV, errno.EPERM, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EMLINK):
+            with transfer_stats_lock:
+                devices = Transfer.devices(source, target)
+                unsupported[devices] = unsupported.get(devices, set()) | set([method])
+        else:
+            raise error
+
+    @staticmethod
+    def devices(source, target):
+        return (os.stat(source).st_dev, os.stat(os.path.dirname(target)).st_dev)
+
+    @staticmethod
+    def count(method, size):
+        with transfer_stats_lock:
+            transfer_stats[method] += size
+
+    @staticmethod
+    def stats():
+        with transfer_stats_lock:
+            return dict(transfer_stats)
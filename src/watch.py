@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import errno
+import select
+import struct
+import shutil
+import tempfile
+import threading
+import ctypes
+import ctypes.util
+from collections import deque
+from common import Common
+from jobs import Jobs
+from transfer import Transfer
+
+class Inotify:
+
+    # Events for the files and directories that appear directly in a directory, through the
+    # inotify API of Linux. Raises OSError (or AttributeError) where inotify is not available.
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+
+    def __init__(self, path):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+        if libc.inotify_add_watch(self.fd, path.encode('utf-8'), Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_TO | Inotify.IN_CREATE) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, "inotify_add_watch failed: "+path)
+
+    def read(self, timeout=None):
+        # returns a list of (mask, name), waiting up to timeout seconds for the first event
+        try:
+            readable, writable, exceptional = select.select([self.fd], [], [], timeout)
+        except InterruptedError:
+            return []
+        if not readable:
+            return []
+        data = os.read(self.fd, 65536)
+        events = []
+        offset = 0
+        while offset + 16 <= len(data):
+            wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+            name = data[offset+16:offset+16+length].rstrip(b'\0').decode('utf-8', 'replace')
+            events.append((mask, name))
+            offset += 16 + length
+        return events
+
+class Watch:
+
+    # Runs the files and directories that arrive in a spool directory through the pipeline, as
+    # journaled jobs (see Jobs), and moves the results to an outbox. An item is taken from the
+    # spool when it has been closed after writing or moved into the spool, or otherwise when it
+    # has not changed for watch-settle seconds. Names starting with "." are ignored, so items can
+    # be written under a hidden name and renamed when they are complete.
+    #
+    # At most watch-workers items are processed at once, and at most watch-queue-size more are
+    # taken from the spool to wait for a worker. Beyond that, the items are left in the spool
+    # until there is room. Without inotify, the spool is scanned every watch-interval seconds.
+
+    def __init__(self, pipeline, spool_path, outbox_path):
+        self.spool_path = os.path.abspath(spool_path)
+        self.outbox_path = os.path.abspath(outbox_path)
+        self.processing_path = self.spool_path+"/.processing"
+        self.failed_path = self.spool_path+"/.failed"
+        for path in [self.outbox_path, self.processing_path, self.failed_path]:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+        workers = int(Common.get_config("watch-workers", 2))
+        self.limit = workers + int(Common.get_config("watch-queue-size", workers))
+        self.settle = float(Common.get_config("watch-settle", 1.0))
+        self.interval = float(Common.get_config("watch-interval", 1.0))
+        self.pending = {}  # name => (fingerprint, time when it was last changed), for items that may still be written to
+        self.ready = deque()
+        self.capacity = threading.Event()  # set when a job is done
+        # the results are in the outbox or in .failed, so finished jobs are not kept in runs-dir
+        self.jobs = Jobs(pipeline, workers=workers, name="watch", finished=self.finished, keep=False)
+
+    def run(self):
+        try:
+            inotify = Inotify(self.spool_path)
+        except (OSError, AttributeError) as e:
+            Common.message("WARNING: inotify is not available, scanning the spool every "+str(self.interval)+" seconds: "+str(e))
+            inotify = None
+        Common.message("Watching for new files in: "+self.spool_path)
+        self.scan()
+        while True:
+            self.settled()
+            while self.ready and self.jobs.active() < self.limit:
+                self.submit(self.ready.popleft())
+
+            if self.ready:
+                # wait for a job to finish before taking more items from the spool
+                self.capacity.wait(self.interval)
+                self.capacity.clear()
+                timeout = 0
+            else:
+                timeout = min(self.settle, self.interval) if self.pending else None
+
+            if inotify is None:
+                time.sleep(self.interval if timeout is None else timeout)
+                self.scan()
+                continue
+            for mask, name in inotify.read(timeout):
+                if mask & Inotify.IN_Q_OVERFLOW:
+                    self.scan()
+                elif name.startswith('.') or name in self.ready:
+                    continue
+                elif mask & (Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_TO):
+                    # complete; but a directory created in place may still be written to
+                    if mask & Inotify.IN_MOVED_TO or not os.path.isdir(self.spool_path+"/"+name):
+                        self.pending.pop(name, None)
+                        self.ready.append(name)
+                    elif not name in self.pending:
+                        self.pending[name] = None
+                elif not name in self.pending:
+                    self.pending[name] = None
+
+    def scan(self):
+        for name in os.listdir(self.spool_path):
+            if not name.startswith('.') and not name in self.pending and not name in self.ready:
+                self.pending[name] = None
+
+    def settled(self):
+        # moves the pending items that have not changed for watch-settle seconds to ready
+        now = time.time()
+        for name in list(self.pending):
+            path = self.spool_path+"/"+name
+            if not os.path.exists(path):
+                del self.pending[name]
+                continue
+            fingerprint = Common.fingerprint(path)
+            if self.pending[name] is None or self.pending[name][0] != fingerprint:
+                self.pending[name] = (fingerprint, now)
+            elif now - self.pending[name][1] >= self.settle:
+                del self.pending[name]
+                self.ready.append(name)
+
+    def submit(self, name):
+        # moves the item out of the spool, so that it is only processed once
+        path = tempfile.mkdtemp(dir=self.processing_path)
+        try:
+            os.rename(self.spool_path+"/"+name, path+"/"+name)
+        except OSError as e:
+            os.rmdir(path)
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        job = self.jobs.submit(path+"/"+name)
+        Common.message("Processing "+name+" as job: "+job['id'])
+
+    def finished(self, job):
+        # may also be called after a restart, for a job whose result was (partly) moved before the process stopped
+        name = os.path.basename(job['input'])
+        if job['state'] == 'finished' and os.path.exists(job['output']):
+            # the result appears in the outbox all at once
+            target = Watch.unique_path(self.outbox_path, name)
+            partial = self.outbox_path+"/."+os.path.basename(target)+".partial"
+            Transfer.move(job['output'], partial)
+            os.rename(partial, target)
+            Common.message("Finished "+name+" with status \""+job['status']+"\": "+target)
+        elif job['state'] != 'finished' and os.path.exists(job['input']):
+            target = Watch.unique_path(self.failed_path, name)
+            Transfer.move(job['input'], target)
+            Common.message("ERROR: "+name+" was "+job['state']+(": "+job['error'] if job['error'] else "")+", moved to: "+target)
+        shutil.rmtree(os.path.dirname(job['input']), ignore_errors=True)
+        self.capacity.set()
+
+    @staticmethod
+    def unique_path(directory, name):
+        path = directory+"/"+name
+        suffix = 1
+        while os.path.exists(path):
+            suffix += 1
+            path = directory+"/"+name+"-"+str(suffix)
+        return path
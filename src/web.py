@@ -1,20 +1,174 @@
 import os
+import json
+import hashlib
+import threading
 from pprint import pprint
+from concurrent.futures import ThreadPoolExecutor
 from common import Common
+from metrics import Metrics
+from jobs import Jobs
+from events import Events
+from pipeline import Pipeline
 
-from flask import Flask, render_template, jsonify
+from flask import Flask, render_template, jsonify, Response, request, send_from_directory
+from werkzeug.serving import BaseWSGIServer
 app = Flask(__name__)
 
+try:
+    import waitress
+except ImportError:
+    waitress = None
+
 global web
 
+class PooledWSGIServer(BaseWSGIServer):
+    
+    # like the threaded development server, but with a fixed number of threads
+    
+    def __init__(self, host, port, app, workers):
+        BaseWSGIServer.__init__(self, host, port, app)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+    
+    def process_request(self, request, client_address):
+        self.executor.submit(self.process_request_thread, request, client_address)
+    
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
 class Web:
     
-    def __init__(self, pipeline, host='0.0.0.0'):
+    def __init__(self, pipeline, host='0.0.0.0', port=5000):
         global web
         web = self
         self.pipeline = pipeline
-        app.run(host=host, debug=True)
+        self.lock = threading.Lock()
+        self.page = None  # the rendered index page and its ETag, until the pipeline is reloaded
+        self.jobs = Jobs(pipeline, workers=int(Common.get_config("job-workers", 2)))
+        
+        # each open event stream occupies a thread, so there should be enough for the dashboards as well
+        workers = int(Common.get_config("web-workers", 16))
+        if Common.get_config("web-server", "production") == "development":
+            # the reloader would start a second process that runs the same jobs
+            app.run(host=host, port=port, debug=True, use_reloader=False, threaded=True)
+        elif waitress:
+            waitress.serve(app, host=host, port=port, threads=workers)
+        else:
+            PooledWSGIServer(host, port, app, workers).serve_forever()
+    
+    def reload(self):
+        # loads the pipeline again, for instance after pipeline.yml has been changed.
+        # Jobs that are already running continue with the old pipeline.
+        pipeline = Pipeline(path=self.pipeline.path, host_path=self.pipeline.host_path)
+        with self.lock:
+            self.pipeline = pipeline
+            self.jobs.pipeline = pipeline
+            self.page = None
+    
+    def get_page(self):
+        with self.lock:
+            if self.page is None:
+                with app.app_context():
+                    body = render_template('index.html', name=os.path.basename(self.pipeline.path), pipeline=self.pipeline.get_serializable(tests=False))
+                self.page = (body, hashlib.sha1(body.encode('utf-8')).hexdigest())
+            return self.page
 
 @app.route("/")
 def index():
-    return render_template('index.html', name=os.path.basename(web.pipeline.path), pipeline=web.pipeline.get_serializable(tests=False))
+    body, etag = web.get_page()
+    response = Response(body, mimetype='text/html')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+@app.route("/reload", methods=['POST'])
+def reload():
+    web.reload()
+    return jsonify(etag=web.get_page()[1])
+
+@app.route("/events")
+def events():
+    # server-sent events with the progress of the running pipelines
+    subscriber = Events.subscribe()
+    def stream():
+        try:
+            yield "retry: 2000\n\n"
+            while True:
+                events, dropped = subscriber.get(timeout=15)
+                if dropped:
+                    yield "event: dropped\ndata: "+json.dumps({ 'type': 'dropped', 'dropped': dropped })+"\n\n"
+                if not events:
+                    yield ": keep-alive\n\n"
+                for event in events:
+                    yield "id: "+str(event['id'])+"\nevent: "+event['type']+"\ndata: "+json.dumps(event)+"\n\n"
+        finally:
+            Events.unsubscribe(subscriber)
+    return Response(stream(), mimetype='text/event-stream', headers={ 'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no' })
+
+@app.route("/metrics")
+def metrics():
+    return Response(Metrics.get().prometheus(), mimetype='text/plain; version=0.0.4')
+
+@app.route("/jobs", methods=['GET'])
+def list_jobs():
+    return jsonify(jobs=web.jobs.list())
+
+@app.route("/jobs", methods=['POST'])
+def submit_job():
+    # the input must be within web-input-dir, and the output is stored in the directory of the run
+    input_dir = Common.get_config("web-input-dir", None)
+    if not input_dir:
+        return jsonify(error="web-input-dir must be set in config.yml to submit jobs"), 403
+    arguments = request.get_json(silent=True) or request.form
+    input_path = arguments.get('input')
+    if not input_path:
+        return jsonify(error="input is missing"), 400
+    if arguments.get('output'):
+        return jsonify(error="output can't be given, the output is stored in the directory of the run"), 400
+    input_dir = os.path.realpath(input_dir)
+    input_path = os.path.realpath(os.path.join(input_dir, input_path))
+    if input_path != input_dir and not input_path.startswith(os.path.join(input_dir, '')):
+        return jsonify(error="input must be within web-input-dir: "+arguments.get('input')), 403
+    if not os.path.exists(input_path):
+        return jsonify(error="input must be an existing file or directory: "+arguments.get('input')), 400
+    job = web.jobs.submit(input_path)
+    return jsonify(job), 201, { 'Location': '/jobs/'+job['id'] }
+
+@app.route("/jobs/<job_id>", methods=['GET'])
+def get_job(job_id):
+    job = web.jobs.get(job_id)
+    if not job:
+        return jsonify(error="no such job: "+job_id), 404
+    return jsonify(job)
+
+@app.route("/jobs/<job_id>", methods=['DELETE'])
+def cancel_job(job_id):
+    job = web.jobs.cancel(job_id)
+    if not job:
+        return jsonify(error="no such job: "+job_id), 404
+    return jsonify(job)
+
+@app.route("/jobs/<job_id>/output/", defaults={ 'path': '' })
+@app.route("/jobs/<job_id>/output/<path:path>")
+def get_job_output(job_id, path):
+    job = web.jobs.get(job_id)
+    if not job:
+        return jsonify(error="no such job: "+job_id), 404
+    # symlinks are resolved, so that they can't point outside of the output
+    output_dir = os.path.realpath(job['output'])
+    fullpath = os.path.realpath(os.path.join(output_dir, path))
+    if fullpath != output_dir and not fullpath.startswith(os.path.join(output_dir, '')):
+        return jsonify(error="no such file: "+path), 404
+    if os.path.isfile(fullpath):
+        return send_from_directory(output_dir, os.path.relpath(fullpath, output_dir))
+    if not os.path.isdir(fullpath):
+        return jsonify(error="no such file: "+path), 404
+    files = []
+    for root, subdirs, filenames in os.walk(fullpath):
+        files.extend([ os.path.relpath(os.path.join(root, file), output_dir) for file in filenames
+                       if os.path.realpath(os.path.join(root, file)).startswith(os.path.join(output_dir, '')) ])
+    return jsonify(files=sorted(files))
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import threading
+from common import Common
+
+global finished_runs
+finished_runs = None  # directories of finished runs that are kept, oldest first
+finished_runs_lock = threading.RLock()
+active_runs = set()  # directories that have been created by this process and are not finished yet
+
+class Workspace:
+
+    # Temporary directories for pipeline runs. Intermediate directories ("pipeline-") are
+    # deleted as soon as they are no longer needed, while the output of finished test runs
+    # ("test-") is kept according to keep-test-output, within the workspace-max-size budget.
+
+    @staticmethod
+    def mkdtemp(prefix):
+        path = tempfile.mkdtemp(prefix=prefix, dir=Common.get_config("work-dir", None))
+        with finished_runs_lock:
+            active_runs.add(path)
+        return path
+
+    @staticmethod
+    def intermediate(path):
+        # whether the path is within a directory of intermediate results ("pipeline-" and "batch-"
+        # directories, and the steps of journaled runs). Only the pipeline reads and writes these.
+        from journal import Journal
+        path = os.path.abspath(path)
+        with finished_runs_lock:
+            roots = [ root for root in active_runs if os.path.basename(root).startswith(('pipeline-', 'batch-')) ]
+        for root in roots:
+            if path.startswith(os.path.join(root, '')):
+                return True
+        runs_dir = os.path.join(os.path.abspath(Journal.runs_dir()), '')
+        return path.startswith(runs_dir) and path[len(runs_dir):].split(os.sep)[1:2] == ['steps']
+    
+    @staticmethod
+    def release(path):
+        shutil.rmtree(path, ignore_errors=True)
+        with finished_runs_lock:
+            active_runs.discard(path)
+
+    @staticmethod
+    def finish(path, failed):
+        # called when a run is done and its output will not be written to anymore.
+        # Returns whether the directory was kept.
+        keep = Common.get_config("keep-test-output", "always")
+        if keep == "never" or keep == "failed" and not failed:
+            Workspace.release(path)
+            return False
+
+        with finished_runs_lock:
+            active_runs.discard(path)
+            Workspace.load_finished_runs()
+            finished_runs.append(path)
+            Workspace.evict(keep=path)
+        return os.path.isdir(path)
+
+    @staticmethod
+    def load_finished_runs():
+        # runs from earlier processes are only known if they are in a dedicated work-dir
+        global finished_runs
+        if finished_runs is not None:
+            return
+        finished_runs = []
+        work_dir = Common.get_config("work-dir", None)
+        if work_dir and os.path.isdir(work_dir):
+            for item in os.listdir(work_dir):
+                if item.startswith('test-') and os.path.isdir(os.path.join(work_dir, item)) and not os.path.join(work_dir, item) in active_runs:
+                    finished_runs.append(os.path.join(work_dir, item))
+            finished_runs.sort(key=lambda path: os.path.getmtime(path))
+
+    @staticmethod
+    def evict(keep):
+        # removes the oldest finished runs, except keep, until they fit within workspace-max-size
+        max_size = Common.get_config("workspace-max-size", None)
+        if max_size is None:
+            return
+        max_size = Common.parse_size(max_size)
+        sizes = dict([(path, Common.tree_size(path)) for path in finished_runs if os.path.isdir(path)])
+        total_size = sum(sizes.values())
+        for path in list(finished_runs):
+            if total_size <= max_size:
+                break
+            if path == keep:
+                continue
+            Workspace.release(path)
+            total_size -= sizes.get(path, 0)
+            finished_runs.remove(path)
+        if total_size > max_size:
+            Common.message("WARNING: the output of the last run alone is larger than workspace-max-size: "+keep)
@@ -0,0 +1,250 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Measures the overhead of running pipelines, without a docker daemon. The docker client is
+# replaced by FakeDockerClient, where each container runs in-process and behaves like the
+# identity image, after sleeping for a configurable, simulated latency for each API call.
+# Each scenario is run in its own process, so that the peak memory usage can be measured.
+#
+# Usage: test/benchmark.py [conditionals] [foreach] [unfold] [--items N] [--latency start=0.05] ...
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import itertools
+import threading
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+scenarios = ['conditionals', 'foreach', 'unfold']
+
+class FakeDockerClient:
+
+    # Implements the parts of docker.Client that are used in common.py. A container copies
+    # /mnt/input to /mnt/output (using hard links when possible), and if it has a command,
+    # writes the command to /mnt/status/status.txt.
+
+    def __init__(self, latencies=None):
+        self.latencies = latencies or {}
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.simulated_seconds = 0.0
+        self.containers = {}
+        self.container_ids = itertools.count(1)
+
+    def call(self, method):
+        latency = float(self.latencies.get(method, 0.0))
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            self.simulated_seconds += latency
+        if latency:
+            time.sleep(latency)
+
+    def build(self, path, rm=True, forcerm=True):
+        self.call('build')
+        return [ '{"stream": "Successfully built '+os.path.basename(os.path.normpath(path))+'\\n"}' ]
+
+    def inspect_image(self, image):
+        self.call('inspect_image')
+        return { 'Id': image }
+
+    def inspect_container(self, container):
+        # the benchmark runs on the host, so all paths are the same on the host
+        self.call('inspect_container')
+        return { 'Mounts': [ { 'Source': '/', 'Destination': '/' } ] }
+
+    def create_host_config(self, binds=None, **limits):
+        return dict(limits, binds=binds or {})
+
+    def create_container(self, image, host_config=None, command=None):
+        self.call('create_container')
+        container = { 'Id': 'fake-'+str(next(self.container_ids)) }
+        with self.lock:
+            self.containers[container['Id']] = { 'binds': host_config['binds'], 'command': command }
+        return container
+
+    def start(self, container):
+        self.call('start')
+        with self.lock:
+            details = self.containers[container['Id']]
+        paths = dict((details['binds'][path]['bind'], path) for path in details['binds'])
+        for bind in ['/mnt/output', '/mnt/status']:
+            if not os.path.exists(paths[bind]):
+                # like docker, which creates missing directories that are mounted
+                os.makedirs(paths[bind])
+        for bind in paths:
+            if bind == '/mnt/input':
+                for item in os.listdir(paths[bind]):
+                    FakeDockerClient.link(os.path.join(paths[bind], item), os.path.join(paths['/mnt/output'], item))
+            elif bind.startswith('/mnt/input/'):
+                FakeDockerClient.link(paths[bind], os.path.join(paths['/mnt/output'], os.path.basename(bind)))
+        if details['command']:
+            with open(paths['/mnt/status']+'/status.txt', 'w') as f:
+                f.write(details['command']+'\n')
+
+    def logs(self, container, stream=False):
+        self.call('logs')
+        return iter([])
+
+    def wait(self, container):
+        self.call('wait')
+        return 0
+
+    def remove_container(self, container, force=False):
+        self.call('remove_container')
+        with self.lock:
+            del self.containers[container['Id']]
+
+    def stats(self, container, decode=False, stream=True):
+        return iter([])
+
+    @staticmethod
+    def link(source, target):
+        if os.path.isdir(source):
+            os.makedirs(target)
+            for item in os.listdir(source):
+                FakeDockerClient.link(os.path.join(source, item), os.path.join(target, item))
+        else:
+            try:
+                os.link(source, target)
+            except OSError:
+                shutil.copy2(source, target)
+
+def write_file(path, text):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        f.write(text)
+
+def generate_conditionals(path, args):
+    # an if/elif chain where only the last condition matches the status of the first step
+    lines = [ 'name: conditionals', 'pipeline:', '  - image: identity', '    command: status-'+str(args.conditions-1) ]
+    for condition in range(args.conditions):
+        lines.append('  - '+('if' if condition == 0 else 'elif')+' status-'+str(condition)+':')
+        lines.append('    - image: identity')
+    lines += [ '  - else:', '    - image: identity' ]
+    write_file(path+"/pipeline/pipeline.yml", "\n".join(lines)+"\n")
+    write_file(path+"/input/item.txt", "item\n")
+    return args.conditions
+
+def generate_foreach(path, args):
+    # a foreach over many small files
+    lines = [ 'name: foreach', 'pipeline:', '  - foreach:' ] + [ '    - image: identity' ] * args.steps
+    write_file(path+"/pipeline/pipeline.yml", "\n".join(lines)+"\n")
+    os.makedirs(path+"/input")
+    for item in range(args.items):
+        with open(path+"/input/"+str(item)+".txt", 'w') as f:
+            f.write(str(item)+"\n")
+    return args.items
+
+def generate_unfold(path, args):
+    # a directory tree with fanout^depth files, which is unfolded completely
+    lines = [ 'name: unfold', 'pipeline:', '  - image: identity', '  - unfold: '+str(args.unfold_depth-1), '  - image: identity' ]
+    write_file(path+"/pipeline/pipeline.yml", "\n".join(lines)+"\n")
+    directories = [ path+"/input" ]
+    for level in range(args.unfold_depth):
+        directories = [ directory+"/"+str(level)+"-"+str(child) for directory in directories for child in range(args.fanout) ]
+    for directory in directories:
+        write_file(directory, os.path.basename(directory)+"\n")
+    return len(directories)
+
+def run_scenario(scenario, args):
+    # runs in the child process; returns the results of the scenario
+    import common
+    from common import Common
+    from pipeline import Pipeline
+    from metrics import Metrics
+
+    path = tempfile.mkdtemp(prefix='benchmark-')
+    try:
+        items = globals()['generate_'+scenario](path, args)
+        write_file(path+"/config/config.yml", json.dumps({ 'work-dir': path+"/work", 'foreach-workers': args.workers }))
+        os.makedirs(path+"/work")
+        os.makedirs(path+"/output")
+        os.makedirs(path+"/status")
+
+        Common.init(path+"/config/config.yml", docker_container='benchmark')
+        client = FakeDockerClient(dict(latency.split('=', 1) for latency in args.latency))
+        common.docker_client = client
+        Common.invalidate_mounts()
+
+        load_start = time.time()
+        pipeline = Pipeline(path=path+"/pipeline/pipeline.yml", host_path=path+"/pipeline")
+        load_seconds = time.time() - load_start
+
+        run_start = time.time()
+        pipeline.run(path+"/config", path+"/input", path+"/output", path+"/status")
+        run_seconds = time.time() - run_start
+
+        steps = sum([ totals['runs'] for totals in Metrics.get().steps.values() ])
+        overhead_seconds = max(0.0, run_seconds - client.simulated_seconds / max(1, args.workers if scenario == 'foreach' else 1))
+        return {
+            'scenario': scenario,
+            'items': items,
+            'steps': steps,
+            'containers': client.calls.get('start', 0),
+            'load_seconds': load_seconds,
+            'run_seconds': run_seconds,
+            'steps_per_second': steps / run_seconds if run_seconds else 0.0,
+            'item_overhead_ms': 1000.0 * overhead_seconds / items if items else 0.0,
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+        }
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Measures the overhead of running pipelines, using a fake docker client.")
+    parser.add_argument('scenarios', nargs='*', metavar='scenario', default=scenarios,
+                        help="which synthetic pipelines to run: "+", ".join(scenarios)+" (default: all)")
+    parser.add_argument('--conditions', type=int, default=1000, help="length of the if/elif chain (default: 1000)")
+    parser.add_argument('--items', type=int, default=10000, help="number of foreach items (default: 10000)")
+    parser.add_argument('--steps', type=int, default=2, help="number of steps in the foreach (default: 2)")
+    parser.add_argument('--workers', type=int, default=1, help="foreach-workers (default: 1)")
+    parser.add_argument('--fanout', type=int, default=10, help="subdirectories per directory in the unfolded tree (default: 10)")
+    parser.add_argument('--unfold-depth', type=int, default=4, help="depth of the unfolded tree (default: 4)")
+    parser.add_argument('--latency', action='append', default=[], metavar='METHOD=SECONDS',
+                        help="simulated latency of a docker API call, for instance start=0.05 (can be repeated)")
+    parser.add_argument('--json', action='store_true', help="print the results as JSON")
+    parser.add_argument('--result', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    for scenario in args.scenarios:
+        if not scenario in scenarios:
+            parser.error("unknown scenario: "+scenario)
+
+    if args.result:
+        # child process: run a single scenario, with the messages from the pipeline going to stdout
+        result = run_scenario(args.scenarios[0], args)
+        with open(args.result, 'w') as f:
+            json.dump(result, f)
+        return
+
+    results = []
+    for scenario in args.scenarios:
+        result_file = tempfile.NamedTemporaryFile(prefix='benchmark-', suffix='.json', delete=False)
+        result_file.close()
+        try:
+            with open(os.devnull, 'w') as devnull:
+                subprocess.check_call([ sys.executable, os.path.abspath(__file__), scenario, '--result', result_file.name ] + [ arg for arg in argv if not arg in scenarios ],
+                                      stdout=devnull)
+            with open(result_file.name, 'r') as f:
+                results.append(json.load(f))
+        finally:
+            os.remove(result_file.name)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print("{:<14}{:>10}{:>10}{:>12}{:>10}{:>10}{:>10}{:>16}{:>14}".format('scenario', 'items', 'steps', 'containers', 'load s', 'run s', 'steps/s', 'overhead/item', 'peak RSS'))
+    for result in results:
+        print("{:<14}{:>10}{:>10}{:>12}{:>10.2f}{:>10.2f}{:>10.1f}{:>13.3f} ms{:>11.1f} MB".format(
+              result['scenario'], result['items'], result['steps'], result['containers'], result['load_seconds'],
+              result['run_seconds'], result['steps_per_second'], result['item_overhead_ms'], result['peak_rss_mb']))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,11 +1,15 @@
 #!/bin/bash
 
-if [ "`ls /mnt/input/ | wc -l`" = 0 ]; then
+INPUT="${PIPELINE_INPUT:-/mnt/input}"
+OUTPUT="${PIPELINE_OUTPUT:-/mnt/output}"
+STATUS="${PIPELINE_STATUS:-/mnt/status}"
+
+if [ "`ls "$INPUT"/ | wc -l`" = 0 ]; then
     echo "no input files!"
 else
-    cp -r /mnt/input/* /mnt/output/
+    cp -r "$INPUT"/* "$OUTPUT"/
 fi
 
 if [ $# -gt 0 ]; then
-    echo "$1" > /mnt/status/status.txt
+    echo "$1" > "$STATUS/status.txt"
 fi
\ No newline at end of file
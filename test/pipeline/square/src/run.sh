@@ -1,8 +1,12 @@
 #!/bin/bash
 
-NUMBER="`cat /mnt/input/number.txt | head -n 1`"
+INPUT="${PIPELINE_INPUT:-/mnt/input}"
+OUTPUT="${PIPELINE_OUTPUT:-/mnt/output}"
+STATUS="${PIPELINE_STATUS:-/mnt/status}"
+
+NUMBER="`cat "$INPUT/number.txt" | head -n 1`"
 RESULT="`echo $(($NUMBER * $NUMBER))`"
 
-echo $RESULT > /mnt/output/number.txt
+echo $RESULT > "$OUTPUT/number.txt"
 
-echo "success" > /mnt/status/status.txt
+echo "success" > "$STATUS/status.txt"
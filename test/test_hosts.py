@@ -0,0 +1,133 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+import docker
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import common
+from common import Common
+from steps import ImageStep
+from hosts import DockerHost, DockerHosts
+from benchmark import FakeDockerClient, write_file
+
+class HostDockerClient(FakeDockerClient):
+
+    # a docker daemon with two CPUs, which keeps track of how many containers run at once on it,
+    # and on all the hosts together
+
+    running = 0
+    peak = 0
+    lock = threading.Lock()
+
+    def __init__(self):
+        FakeDockerClient.__init__(self, { 'start': 0.1 })
+        self.host_running = 0
+        self.host_peak = 0
+
+    def info(self):
+        return { 'NCPU': 2 }
+
+    def start(self, container):
+        with HostDockerClient.lock:
+            HostDockerClient.running += 1
+            HostDockerClient.peak = max(HostDockerClient.peak, HostDockerClient.running)
+            self.host_running += 1
+            self.host_peak = max(self.host_peak, self.host_running)
+        try:
+            FakeDockerClient.start(self, container)
+        finally:
+            with HostDockerClient.lock:
+                HostDockerClient.running -= 1
+                self.host_running -= 1
+
+class FailingDockerClient(FakeDockerClient):
+
+    # a docker daemon that responds to starting a container with the given status code
+
+    def __init__(self, status_code):
+        FakeDockerClient.__init__(self)
+        self.status_code = status_code
+        self.removed = []
+
+    def start(self, container):
+        self.call('start')
+        response = requests.models.Response()
+        response.status_code = self.status_code
+        response._content = b'failed'
+        raise docker.errors.APIError("failed", response)
+
+    def remove_container(self, container, force=False):
+        self.removed.append((container['Id'], force))
+        FakeDockerClient.remove_container(self, container, force=force)
+
+class TestHosts(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='test-hosts-')
+        write_file(self.path+"/input/item.txt", "item\n")
+        # the budget of this machine must not limit the containers on the docker hosts
+        write_file(self.path+"/config/config.yml", json.dumps({ 'work-dir': self.path, 'host-cpus': 1 }))
+        Common.init(self.path+"/config/config.yml", docker_container='test')
+        common.docker_client = FakeDockerClient()
+        Common.invalidate_mounts()
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def volumes(self, name):
+        return {
+            self.path+"/input": { 'bind': '/mnt/input', 'mode': 'ro' },
+            self.path+"/"+name+"/output": { 'bind': '/mnt/output', 'mode': 'rw' },
+            self.path+"/"+name+"/status": { 'bind': '/mnt/status', 'mode': 'rw' }
+        }
+
+    def test_budget_per_host(self):
+        clients = [ HostDockerClient(), HostDockerClient() ]
+        hosts = DockerHosts([ DockerHost('a', workers=4, client=clients[0], cpus=2), DockerHost('b', workers=4, client=clients[1]) ])
+        step = ImageStep('pipeline.yml:1', 0, 'identity', 'identity', cpus=2)
+        threads = [ threading.Thread(target=hosts.run, args=(step, self.volumes(str(container)))) for container in range(4) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([ client.calls['start'] for client in clients ], [ 2, 2 ])
+        self.assertEqual([ client.host_peak for client in clients ], [ 1, 1 ])
+        self.assertEqual(HostDockerClient.peak, 2)
+        for container in range(4):
+            self.assertTrue(os.path.exists(self.path+"/"+str(container)+"/output/item.txt"))
+
+    def test_failed_host(self):
+        # the container on the failed host is removed, and the step is run on the other host
+        failing, working = FailingDockerClient(500), FakeDockerClient()
+        hosts = DockerHosts([ DockerHost('a', client=failing), DockerHost('b', client=working) ])
+        step = ImageStep('pipeline.yml:1', 0, 'identity', 'identity')
+        self.assertEqual(hosts.run(step, self.volumes('0')), 0)
+        self.assertEqual(failing.removed, [ ('fake-1', True) ])
+        self.assertEqual(working.calls['start'], 1)
+        self.assertTrue(hosts.hosts[0].failed_until > time.time())
+        self.assertTrue(os.path.exists(self.path+"/0/output/item.txt"))
+
+    def test_client_error(self):
+        # an error in the request would fail on any host, so it is not retried
+        failing, working = FailingDockerClient(404), FakeDockerClient()
+        hosts = DockerHosts([ DockerHost('a', client=failing), DockerHost('b', client=working) ])
+        step = ImageStep('pipeline.yml:1', 0, 'identity', 'identity')
+        with self.assertRaises(docker.errors.APIError):
+            hosts.run(step, self.volumes('0'))
+        self.assertEqual(failing.removed, [ ('fake-1', True) ])
+        self.assertEqual(working.calls.get('start', 0), 0)
+        self.assertEqual(hosts.hosts[0].failed_until, 0.0)
+
+if __name__ == '__main__':
+    unittest.main()
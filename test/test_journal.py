@@ -0,0 +1,111 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import common
+from common import Common
+from events import Events
+from benchmark import FakeDockerClient, write_file
+
+class CrashingDockerClient(FakeDockerClient):
+
+    # the container with the given number fails after it has written its output,
+    # like when the docker daemon goes away while it is running
+
+    def __init__(self, crash_at=None):
+        FakeDockerClient.__init__(self)
+        self.crash_at = crash_at
+        self.started = 0
+
+    def start(self, container):
+        with self.lock:
+            self.started += 1
+            started = self.started
+        FakeDockerClient.start(self, container)
+        if started == self.crash_at:
+            raise Exception("the docker daemon went away")
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='test-journal-')
+        write_file(self.path+"/pipeline/pipeline.yml", "\n".join([
+            'name: resume',
+            'pipeline:',
+            '  - image: identity',
+            '  - foreach:',
+            '    - image: identity',
+            '    - image: identity',
+            '  - image: identity'
+        ])+"\n")
+        for item in range(4):
+            write_file(self.path+"/input/"+str(item)+".txt", str(item)+"\n")
+        write_file(self.path+"/config/config.yml", json.dumps({ 'work-dir': self.path+"/work", 'runs-dir': self.path+"/runs" }))
+        os.makedirs(self.path+"/work")
+        Common.init(self.path+"/config/config.yml", docker_container='test')
+        Common.invalidate_mounts()
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def run_pipeline(self, journal, client):
+        from pipeline import Pipeline
+        common.docker_client = client
+        pipeline = Pipeline(path=self.path+"/pipeline/pipeline.yml", host_path=self.path+"/pipeline")
+        return pipeline.run_journaled(journal)
+
+    def resume(self, crash_at):
+        # returns the number of containers that are run when resuming
+        from journal import Journal
+        journal = Journal.create(self.path+"/input", self.path+"/output")
+        with self.assertRaises(Exception):
+            self.run_pipeline(journal, CrashingDockerClient(crash_at=crash_at))
+        client = CrashingDockerClient()
+        self.run_pipeline(Journal.open(journal.run_id), client)
+        return client.started
+
+    def test_resume_inside_foreach(self):
+        # the first step and two items are done when the third item fails
+        self.assertEqual(self.resume(crash_at=6), 2 + 2 + 1)
+        self.assert_output()
+
+    def test_resume_last_step(self):
+        self.assertEqual(self.resume(crash_at=10), 1)
+        self.assert_output()
+
+    def test_resume_events(self):
+        # the steps that are skipped when resuming are reported as finished
+        subscriber = Events.subscribe()
+        try:
+            self.resume(crash_at=6)
+            events, dropped = subscriber.get(timeout=0)
+        finally:
+            Events.unsubscribe(subscriber)
+        # the events of the second attempt
+        events = events[max([ index for index, event in enumerate(events) if event['type'] == 'run-started' ]):]
+        started = [ event['step_id'] for event in events if event['type'] == 'step-started' ]
+        finished = [ event['step_id'] for event in events if event['type'] == 'step-finished' ]
+        skipped = [ event['step_id'] for event in events if event['type'] == 'step-finished' and event.get('skipped') ]
+        self.assertEqual(sorted(started), sorted(finished))
+        # the first step, and both steps of the two items that were done
+        self.assertEqual(len(skipped), 1 + 2 + 2)
+        self.assertIn('/0', skipped)
+
+    def assert_output(self):
+        for item in range(4):
+            name = str(item)+".txt"
+            with open(self.path+"/output/"+name+"/"+name, 'r') as f:
+                self.assertEqual(f.read(), str(item)+"\n")
+        self.assertEqual(sorted(os.listdir(self.path+"/output")), [ str(item)+".txt" for item in range(4) ])
+
+if __name__ == '__main__':
+    unittest.main()
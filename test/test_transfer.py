@@ -0,0 +1,63 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import common
+from common import Common
+from transfer import Transfer
+from benchmark import FakeDockerClient, write_file
+
+class TestTransfer(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='test-transfer-')
+        write_file(self.path+"/input/item.txt", "item\n")
+        write_file(self.path+"/config/config.yml", json.dumps({ 'work-dir': self.path+"/work" }))
+        os.makedirs(self.path+"/work")
+        os.makedirs(self.path+"/output")
+        os.makedirs(self.path+"/status")
+        Common.init(self.path+"/config/config.yml", docker_container='test')
+        common.docker_client = FakeDockerClient()
+        Common.invalidate_mounts()
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def run_pipeline(self, lines):
+        # returns the number of bytes transferred with each method
+        from pipeline import Pipeline
+        write_file(self.path+"/pipeline/pipeline.yml", "\n".join([ 'name: transfer', 'pipeline:' ] + lines)+"\n")
+        pipeline = Pipeline(path=self.path+"/pipeline/pipeline.yml", host_path=self.path+"/pipeline")
+        before = Transfer.stats()
+        pipeline.run(None, self.path+"/input", self.path+"/output", self.path+"/status")
+        after = Transfer.stats()
+        return dict((method, after[method] - before[method]) for method in after)
+
+    def assert_not_linked_to_input(self):
+        output = os.stat(self.path+"/output/item.txt")
+        self.assertNotEqual(output.st_ino, os.stat(self.path+"/input/item.txt").st_ino)
+        self.assertEqual(output.st_nlink, 1)
+
+    def test_pass_through_intermediate(self):
+        # the if without an else passes on the output of the previous step, which is an intermediate result
+        transferred = self.run_pipeline([ '  - image: identity', '  - if no-match:', '    - image: identity' ])
+        self.assertEqual(transferred['hardlinked'], len("item\n"))
+        self.assertEqual(transferred['reflinked'] + transferred['copied'], 0)
+
+    def test_pass_through_input(self):
+        transferred = self.run_pipeline([ '  - if no-match:', '    - image: identity' ])
+        self.assertEqual(transferred['hardlinked'], 0)
+        self.assertEqual(transferred['reflinked'] + transferred['copied'], len("item\n"))
+        self.assert_not_linked_to_input()
+
+if __name__ == '__main__':
+    unittest.main()